@@ -51,11 +51,22 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'test-dbsharing',
-    }
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'test-dbsharing-replica',
+        'TEST_MIRROR': 'default',
+    },
 }
 
 import shareddb
 DATABASES = shareddb.patch_databases(DATABASES)
+DATABASES['default']['SHAREDDB_STATS'] = True
+
+TEST_RUNNER = 'shareddb.runner.DiscoverRunner'
+
+# Leave room for both shared and per-class live servers
+os.environ.setdefault('DJANGO_LIVE_TEST_SERVER_ADDRESS', 'localhost:8081-8090')
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
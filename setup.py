@@ -40,8 +40,11 @@ setup(
     keywords=['django', 'liveserver', 'shared connection'],
     url="https://github.com/rbarrois/%s/" % PYPI_PACKAGE,
     download_url="https://pypi.python.org/pypi/%s/" % PYPI_PACKAGE,
-    packages=['shareddb', 'shareddb.backends', 'shareddb.backends.shareddb'],
+    packages=['shareddb', 'shareddb.backends', 'shareddb.backends.shareddb', 'shareddb.backends.remote'],
     install_requires=codecs.open('requirements.txt', 'r', 'utf-8').readlines(),
+    entry_points={
+        'pytest11': ['shareddb = shareddb.pytest_plugin'],
+    },
     setup_requires=[
         'setuptools>=0.8',
     ],
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Raphaël Barrois
+# This software is distributed under the two-clause BSD license.
+
+"""A database engine running all statements on another process' shared connection.
+
+Settings:
+
+    DATABASES = {
+        'default': {
+            'ENGINE': 'shareddb.backends.remote',
+            'INNER_ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': 'test-dbsharing',
+            'SHAREDDB_SOCKET': '/tmp/shareddb/default.sock',
+        }
+    }
+
+The ``INNER_ENGINE`` must match the one wrapped by the serving process: it
+provides the SQL dialect, while statements are run through the socket.
+"""
+
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import utils
+
+from ... import remote
+from ..shareddb import base as shareddb_base
+
+
+class RemoteDatabaseWrapper(object):
+    """Mixin for an inner engine's DatabaseWrapper, connecting to a DelegateServer."""
+
+    def get_new_connection(self, conn_params):
+        return remote.RemoteConnection(
+            self.settings_dict['SHAREDDB_SOCKET'],
+            database=self.Database,
+            fetch_size=self.settings_dict.get('SHAREDDB_FETCH_SIZE', shareddb_base.DEFAULT_FETCH_SIZE),
+        )
+
+    def init_connection_state(self):
+        # The serving process already initialized the shared connection.
+        pass
+
+    def create_cursor(self):
+        return self.connection.cursor()
+
+    def _set_autocommit(self, autocommit):
+        with self.wrap_database_errors:
+            self.connection.set_autocommit(autocommit)
+
+    def _start_transaction_under_autocommit(self):
+        self.connection.begin()
+
+    def is_usable(self):
+        try:
+            return self.connection.ping()
+        except Exception:
+            return False
+
+
+# One wrapper class per inner engine
+WRAPPER_CLASSES = {}
+
+
+def DatabaseWrapper(settings_dict, alias, **kwargs):
+    """Generate a RemoteDatabaseWrapper for the given alias.
+
+    Django expects this class to exist and to be callable.
+    """
+    for key in ('INNER_ENGINE', 'SHAREDDB_SOCKET'):
+        if not settings_dict.get(key):
+            raise ImproperlyConfigured(
+                "The shareddb.backends.remote database engine requires a %r setting." % key)
+
+    inner_engine_module_name = settings_dict['INNER_ENGINE']
+    if inner_engine_module_name not in WRAPPER_CLASSES:
+        inner_engine_module = utils.load_backend(inner_engine_module_name)
+
+        class InnerDatabaseWrapper(RemoteDatabaseWrapper, inner_engine_module.DatabaseWrapper):
+            pass
+
+        WRAPPER_CLASSES[inner_engine_module_name] = InnerDatabaseWrapper
+
+    return WRAPPER_CLASSES[inner_engine_module_name](settings_dict, alias, **kwargs)
@@ -2,30 +2,446 @@
 # Copyright (c) 2014 Raphaël Barrois
 # This software is distributed under the two-clause BSD license.
 
+import collections
+import functools
+import re
+import threading
 
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
 from django.db import utils
 from django.db import backends
 
 
+from ... import SHAREDDB_ENGINE
 from ... import threlegate
+from ...compat import register_at_fork, timer
 
 
 # Only spawn one thread per DB alias, and keep them in this global variable.
 DELEGATES = {}
 
+# Available serialization strategies, selected by the SHAREDDB_MODE setting.
+# - 'thread': run all calls on a dedicated thread; works with any driver
+# - 'lock': run calls on the caller's thread, under a lock; requires a driver
+#   that accepts cross-thread use (psycopg2, sqlite with check_same_thread=False)
+MODE_THREAD = 'thread'
+MODE_LOCK = 'lock'
+DELEGATE_CLASSES = {
+    MODE_THREAD: threlegate.DelegateQueue,
+    MODE_LOCK: threlegate.DelegateLock,
+}
+
+
+def get_mode(settings_dict):
+    mode = settings_dict.get('SHAREDDB_MODE', MODE_THREAD)
+    if mode not in DELEGATE_CLASSES:
+        raise ImproperlyConfigured(
+            "Invalid SHAREDDB_MODE %r; expected one of %s." % (mode, ', '.join(sorted(DELEGATE_CLASSES))))
+    return mode
+
+
+def get_scheduling(settings_dict):
+    """Order of calls from different threads, from SHAREDDB_SCHEDULING; see threlegate.SCHEDULERS."""
+    scheduling = settings_dict.get('SHAREDDB_SCHEDULING', threlegate.SCHEDULING_FIFO)
+    if scheduling not in threlegate.SCHEDULERS:
+        raise ImproperlyConfigured(
+            "Invalid SHAREDDB_SCHEDULING %r; expected one of %s." % (
+                scheduling, ', '.join(sorted(threlegate.SCHEDULERS))))
+    if scheduling != threlegate.SCHEDULING_FIFO and get_mode(settings_dict) != MODE_THREAD:
+        raise ImproperlyConfigured(
+            "SHAREDDB_SCHEDULING %r requires SHAREDDB_MODE %r." % (scheduling, MODE_THREAD))
+    if scheduling != threlegate.SCHEDULING_FIFO and settings_dict.get('SHAREDDB_COALESCE'):
+        # A shared read runs in the lane of its first caller: it could overtake
+        # the writes of the others.
+        raise ImproperlyConfigured(
+            "SHAREDDB_COALESCE requires SHAREDDB_SCHEDULING %r." % threlegate.SCHEDULING_FIFO)
+    return scheduling
+
 
 def make_delegate(settings_dict, alias):
     key = alias
     if key not in DELEGATES:
-        delegate = threlegate.DelegateQueue(name='delegate-%s' % alias)
+        mode = get_mode(settings_dict)
+        kwargs = {}
+        scheduling = get_scheduling(settings_dict)
+        if mode == MODE_THREAD:
+            kwargs['scheduling'] = scheduling
+            kwargs['idle_timeout'] = settings_dict.get('SHAREDDB_IDLE_TIMEOUT')
+            kwargs['spin'] = settings_dict.get('SHAREDDB_SPIN', 0.0)
+            kwargs['timeout'] = settings_dict.get('SHAREDDB_TIMEOUT')
+        delegate = DELEGATE_CLASSES[mode](
+            name='delegate-%s' % alias,
+            stats=settings_dict.get('SHAREDDB_STATS', False),
+            **kwargs
+        )
         DELEGATES[key] = delegate
         # Start once registered, in case something is also trying to spawn the alias.
+        # In 'thread' mode, the thread itself is only spawned by the first call.
         delegate.start()
 
     return DELEGATES[key]
 
 
+def shutdown_delegates():
+    """Close the shared connections, and stop all delegates.
+
+    They are started again if used afterwards.
+    """
+    for alias, delegate in list(DELEGATES.items()):
+        if not delegate.started:
+            continue
+        wrapper = SHARED_WRAPPERS.get(alias)
+        if wrapper is not None:
+            wrapper.close()
+        delegate.stop()
+        # Keep accepting calls: they would spawn the thread again.
+        delegate.start()
+
+
+# Number of rows pulled from the inner cursor per delegated fetch.
+DEFAULT_FETCH_SIZE = 500
+
+
+class PrefetchingCursor(object):
+    """Base for cursors serving fetches from a buffer of prefetched rows.
+
+    Subclasses implement ``_fetch_chunk(size)`` and ``_fetch_remaining()``,
+    and call ``_reset()`` whenever a new statement is run.
+    """
+    def __init__(self, fetch_size=DEFAULT_FETCH_SIZE):
+        self.fetch_size = fetch_size
+        self._buffer = collections.deque()
+        self._exhausted = False
+        self._rows_type = list
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def _reset(self, rows=(), exhausted=False, rows_type=list):
+        """Start over with a new result, ``rows`` being its prefetched rows.
+
+        ``rows_type`` is the type of sequences the driver returns rows in:
+        fetches return the same (e.g. a tuple, even when empty, for MySQLdb).
+        """
+        self._buffer.clear()
+        self._buffer.extend(rows)
+        self._exhausted = exhausted
+        self._rows_type = rows_type
+
+    def _fetch_chunk(self, size):
+        raise NotImplementedError()
+
+    def _fetch_remaining(self):
+        raise NotImplementedError()
+
+    def _fill(self, size):
+        """Pull up to ``size`` more rows from the underlying cursor."""
+        if self._exhausted:
+            return
+        rows = self._fetch_chunk(size)
+        self._rows_type = type(rows)
+        if len(rows) < size:
+            # DB-API: a short read means no more rows are available.
+            self._exhausted = True
+        self._buffer.extend(rows)
+
+    def fetchone(self):
+        if not self._buffer:
+            self._fill(self.fetch_size)
+        if self._buffer:
+            return self._buffer.popleft()
+        return None
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        if len(self._buffer) < size:
+            self._fill(max(self.fetch_size, size - len(self._buffer)))
+        count = min(size, len(self._buffer))
+        return self._rows_type(self._buffer.popleft() for _i in range(count))
+
+    def fetchall(self):
+        rows = list(self._buffer)
+        self._buffer.clear()
+        if not self._exhausted:
+            remaining = self._fetch_remaining()
+            self._rows_type = type(remaining)
+            rows.extend(remaining)
+            self._exhausted = True
+        return self._rows_type(rows)
+
+
+# SELECT clauses with effects beyond reading: row locks (FOR UPDATE, FOR SHARE,
+# FOR NO KEY UPDATE, FOR KEY SHARE; MySQL's LOCK IN SHARE MODE) and SELECT ... INTO.
+WRITING_CLAUSES = re.compile(r'\b(?:FOR\s+(?:UPDATE|SHARE|NO\s+KEY|KEY)|LOCK\s+IN\s+SHARE\s+MODE|INTO)\b', re.I)
+
+
+def is_read(sql):
+    """Whether a statement only reads data, and may run without its savepoint.
+
+    Functions with side effects (e.g. ``nextval()``) can't be told apart:
+    see DelegatingCursor's ``uncached``.
+    """
+    words = sql.split(None, 1)
+    return bool(words) and words[0].upper() == 'SELECT' and not WRITING_CLAUSES.search(sql)
+
+
+def cache_key(sql, params):
+    """A hashable key for a statement, or None if its params can't be hashed."""
+    if isinstance(params, dict):
+        params = tuple(sorted(params.items()))
+    elif params is not None:
+        params = tuple(params)
+    key = (sql, params)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class QueryCache(object):
+    """LRU cache of read results, shared by all cursors of a connection.
+
+    Entries are (description, rowcount, rows, rows_type) tuples; they are
+    filled and invalidated on the delegate, so that they stay ordered with writes.
+    Results with more than ``max_rows`` rows aren't cached.
+    """
+    def __init__(self, size, max_rows=DEFAULT_FETCH_SIZE):
+        self.size = size
+        self.max_rows = max_rows
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Most recently used last
+            self.entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DelegatingCursor(PrefetchingCursor):
+    """Wraps a DB-API cursor, running all its calls on a DelegateQueue.
+
+    Rows are prefetched from the inner cursor in chunks of ``fetch_size``,
+    so that ``fetchone()``-style iteration costs a thread hop per chunk
+    instead of one per row. For reads, the first chunk is fetched along with
+    the statement: reads returning fewer rows cost a single hop.
+
+    Each statement is reported to the callables in ``listeners``, as a dict
+    with the following keys: sql, params, thread (the calling thread, even
+    for statements run by the delegate on its behalf),
+    duration, rowcount (as reported by the cursor), fetched (rows fetched
+    so far), cached (whether it was served from the ``cache``) and coalesced
+    (whether its result came from an identical statement of another cursor).
+
+    If provided, ``prepare(sql)`` is called on the delegate before each statement.
+
+    With a QueryCache, reads are served from it when possible.
+    With ``coalesce``, identical reads queued at the same time on the delegate
+    run once; see DelegateQueue.execute_shared().
+    Statements containing any of the strings in ``uncached`` are never
+    cached nor coalesced.
+    """
+    def __init__(self, cursor, delegate, fetch_size=DEFAULT_FETCH_SIZE, listeners=(), prepare=None,
+            cache=None, coalesce=False, uncached=()):
+        super(DelegatingCursor, self).__init__(fetch_size=fetch_size)
+        self.cursor = cursor
+        self.delegate = delegate
+        self.listeners = listeners
+        self.prepare = prepare
+        self.cache = cache
+        self.coalesce = coalesce
+        self.uncached = uncached
+        self._query = None
+        # (description, rowcount) of a result fetched by _read()
+        self._result = None
+
+    def __getattr__(self, attr):
+        cursor_attr = getattr(self.cursor, attr)
+        if callable(cursor_attr):
+            return functools.partial(self.delegate.execute, cursor_attr)
+        return cursor_attr
+
+    @property
+    def description(self):
+        if self._result is not None:
+            return self._result[0]
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        if self._result is not None:
+            return self._result[1]
+        return getattr(self.cursor, 'rowcount', -1)
+
+    # Statements
+    # ==========
+
+    def _prepared(self, method, sql, *args):
+        self.prepare(sql)
+        return method(*args)
+
+    def _notify(self, sql, params, start, fetched=0, cached=False, coalesced=False):
+        self._query = {
+            'sql': sql,
+            'params': params,
+            'thread': self.delegate.calling_thread(),
+            'duration': timer() - start,
+            'rowcount': self.rowcount,
+            'fetched': fetched,
+            'cached': cached,
+            'coalesced': coalesced,
+        }
+        for listener in list(self.listeners):
+            listener(self._query)
+
+    def _run_statement(self, method, sql, params, *args):
+        """Run a statement-issuing method of the inner cursor."""
+        self._reset()
+        self._query = None
+        self._result = None
+        if self.prepare is not None:
+            args = (method, sql) + args
+            method = self._prepared
+        if not self.listeners:
+            return self.delegate.execute(method, *args)
+
+        start = timer()
+        try:
+            return self.delegate.execute(method, *args)
+        finally:
+            self._notify(sql, params, start)
+
+    def _read(self, key, sql, params):
+        """Run a read, prefetching its first rows; runs on the delegate.
+
+        Returns (cursor, (description, rowcount, rows, rows_type), exhausted),
+        cursor being this one, which holds any remaining rows.
+        The result is cached under ``key``, unless it is None.
+        """
+        if self.prepare is not None:
+            self.prepare(sql)
+        if params is None:
+            self.cursor.execute(sql)
+        else:
+            self.cursor.execute(sql, params)
+        description = self.cursor.description
+        if description is None:
+            rows, rows_type = [], list
+        else:
+            rows = self.cursor.fetchmany(self.fetch_size + 1)
+            rows_type = type(rows)
+            rows = list(rows)
+        exhausted = len(rows) <= self.fetch_size
+        entry = (description, self.cursor.rowcount, rows, rows_type)
+        if key is not None and self.cache is not None and exhausted and len(rows) <= self.cache.max_rows:
+            # Results too large to be cached are fetched lazily, as usual.
+            self.cache.set(key, entry)
+        return self, entry, exhausted
+
+    def _run_read(self, key, sql, params):
+        """Run a read through _read(); ``key`` is None if it can't be cached nor coalesced."""
+        self._reset()
+        self._query = None
+        self._result = None
+        start = timer()
+        entry = None
+        if key is not None and self.cache is not None and not self.delegate.has_deferred():
+            # Otherwise, go through the delegate: it reports failed deferred calls.
+            entry = self.cache.get(key)
+        cached = entry is not None
+        coalesced = False
+        exhausted = True
+        if not cached:
+            try:
+                if key is not None and self.coalesce:
+                    owner, entry, exhausted = self.delegate.execute_shared(key, self._read, key, sql, params)
+                    coalesced = owner is not self
+                    if coalesced and not exhausted:
+                        # The remaining rows are on the other cursor: run our own.
+                        owner, entry, exhausted = self.delegate.execute(self._read, key, sql, params)
+                        coalesced = False
+                else:
+                    _owner, entry, exhausted = self.delegate.execute(self._read, key, sql, params)
+            except Exception:
+                if self.listeners:
+                    self._notify(sql, params, start)
+                raise
+        description, rowcount, rows, rows_type = entry
+        self._result = (description, rowcount)
+        self._reset(rows, exhausted, rows_type)
+        if self.listeners:
+            self._notify(sql, params, start, fetched=len(rows), cached=cached, coalesced=coalesced)
+        return self
+
+    def _is_uncached(self, sql):
+        return any(marker in sql for marker in self.uncached)
+
+    def _wrap_result(self, result):
+        # Don't leak the inner cursor to callers chaining on execute().
+        return self if result is self.cursor else result
+
+    def execute(self, sql, params=None):
+        if is_read(sql):
+            key = None
+            if (self.cache is not None or self.coalesce) and not self._is_uncached(sql):
+                key = cache_key(sql, params)
+            return self._run_read(key, sql, params)
+        if params is None:
+            result = self._run_statement(self.cursor.execute, sql, params, sql)
+        else:
+            result = self._run_statement(self.cursor.execute, sql, params, sql, params)
+        return self._wrap_result(result)
+
+    def executemany(self, sql, param_list):
+        return self._wrap_result(
+            self._run_statement(self.cursor.executemany, sql, param_list, sql, param_list))
+
+    def callproc(self, procname, params=None):
+        if params is None:
+            return self._run_statement(self.cursor.callproc, procname, params, procname)
+        return self._run_statement(self.cursor.callproc, procname, params, procname, params)
+
+    # Fetching
+    # ========
+
+    def _fetch_chunk(self, size):
+        rows = self.delegate.execute(self.cursor.fetchmany, size)
+        if self._query is not None:
+            self._query['fetched'] += len(rows)
+        return rows
+
+    def _fetch_remaining(self):
+        rows = self.delegate.execute(self.cursor.fetchall)
+        if self._query is not None:
+            self._query['fetched'] += len(rows)
+        return rows
+
+
 # Store a single wrapper per DatabaseWrapper, too.
 SHARED_WRAPPERS = {}
 
@@ -34,14 +450,40 @@ class DelegatingDatabaseWrapper(backends.BaseDatabaseWrapper):
     """Abstract DatabaseWrapper, delegates functions to its DelegateQueue."""
     def __init__(self, delegate, settings_dict, alias, **kwargs):
         self.delegate = delegate
+        self.fetch_size = settings_dict.get('SHAREDDB_FETCH_SIZE', DEFAULT_FETCH_SIZE)
+        # Callables notified of every statement; see DelegatingCursor.
+        self.query_listeners = []
+        # With SHAREDDB_PIPELINE, don't wait for calls whose result is never used.
+        self.pipeline = settings_dict.get('SHAREDDB_PIPELINE', False)
+        # Savepoints not created yet, until a statement needs them; see _savepoint().
+        self.pending_savepoints = []
+        # With SHAREDDB_COALESCE, run identical concurrent reads once; see DelegatingCursor.
+        self.coalesce = settings_dict.get('SHAREDDB_COALESCE', False)
+        # Statements never cached nor coalesced, from SHAREDDB_UNCACHED.
+        self.uncached = tuple(settings_dict.get('SHAREDDB_UNCACHED', ()))
+        # With SHAREDDB_QUERY_CACHE = <size>, cache read results; see QueryCache.
+        cache_size = settings_dict.get('SHAREDDB_QUERY_CACHE')
+        self.query_cache = QueryCache(cache_size, max_rows=self.fetch_size) if cache_size else None
         super(DelegatingDatabaseWrapper, self).__init__(settings_dict, alias, **kwargs)
-        self.allow_thread_sharing = False
+        # On PostgreSQL, a failing read aborts the transaction until the
+        # enclosing savepoint gets rolled back: create them before reads, too.
+        self.elide_read_savepoints = self.vendor != 'postgresql'
+        # In 'lock' mode, calls run on the calling threads themselves.
+        self.allow_thread_sharing = get_mode(settings_dict) == MODE_LOCK
 
     # DB object creation
     # ==================
 
     def create_cursor(self):
-        return self.delegate.execute(super(DelegatingDatabaseWrapper, self).create_cursor)
+        cursor = self.delegate.execute(super(DelegatingDatabaseWrapper, self).create_cursor)
+        return DelegatingCursor(cursor, self.delegate,
+            fetch_size=self.fetch_size,
+            listeners=self.query_listeners,
+            prepare=self._before_statement,
+            cache=self.query_cache,
+            coalesce=self.coalesce,
+            uncached=self.uncached,
+        )
 
     def get_new_connection(self, conn_params):
         return self.delegate.execute(super(DelegatingDatabaseWrapper, self).get_new_connection, conn_params)
@@ -52,18 +494,93 @@ class DelegatingDatabaseWrapper(backends.BaseDatabaseWrapper):
     def cursor(self):
         return self.delegate.execute(super(DelegatingDatabaseWrapper, self).cursor)
 
+    def _execute_pipelined(self, function, *args):
+        """Run a call whose result is ignored, without waiting for it if pipelining."""
+        if self.pipeline:
+            self.delegate.execute_nowait(function, *args)
+        else:
+            self.delegate.execute(function, *args)
+
     def commit(self):
+        # Not pipelined: callers must know whether their transaction made it.
         return self.delegate.execute(super(DelegatingDatabaseWrapper, self).commit)
 
     def rollback(self):
         return self.delegate.execute(super(DelegatingDatabaseWrapper, self).rollback)
 
     def close(self):
+        if self.connection is None and not self.in_atomic_block:
+            # Nothing to close: don't spawn the delegate thread for that.
+            return
         return self.delegate.execute(super(DelegatingDatabaseWrapper, self).close)
 
+    def validate_thread_sharing(self):
+        # Calls run on the delegate thread, which may be spawned after the
+        # wrapper was built, and again after being idle.
+        if not self.delegate.in_thread():
+            super(DelegatingDatabaseWrapper, self).validate_thread_sharing()
+
+    def set_autocommit(self, autocommit):
+        # Keep ordered with pipelined calls.
+        return self.delegate.execute(super(DelegatingDatabaseWrapper, self).set_autocommit, autocommit)
+
+    def _commit(self):
+        del self.pending_savepoints[:]
+        return super(DelegatingDatabaseWrapper, self)._commit()
+
+    def _rollback(self):
+        del self.pending_savepoints[:]
+        self._invalidate_cache()
+        return super(DelegatingDatabaseWrapper, self)._rollback()
+
+    def _close(self):
+        del self.pending_savepoints[:]
+        self._invalidate_cache()
+        return super(DelegatingDatabaseWrapper, self)._close()
+
+    def _invalidate_cache(self):
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
     # Savepoint-related
     # =================
 
+    # Most atomic blocks in views only read: savepoints are only created on the
+    # database before the first statement that may need rolling back.
+    # Those methods run on the delegate.
+
+    def _before_statement(self, sql):
+        if self.query_cache is not None and not is_read(sql):
+            self.query_cache.clear()
+        if self.pending_savepoints and not (self.elide_read_savepoints and is_read(sql)):
+            sids = list(self.pending_savepoints)
+            del self.pending_savepoints[:]
+            for sid in sids:
+                super(DelegatingDatabaseWrapper, self)._savepoint(sid)
+
+    def _drop_pending_savepoint(self, sid):
+        """Forget a pending savepoint, and those nested in it; return whether it was pending."""
+        try:
+            index = self.pending_savepoints.index(sid)
+        except ValueError:
+            # All pending savepoints are nested in a created one.
+            del self.pending_savepoints[:]
+            return False
+        del self.pending_savepoints[index:]
+        return True
+
+    def _savepoint(self, sid):
+        self.pending_savepoints.append(sid)
+
+    def _savepoint_rollback(self, sid):
+        self._invalidate_cache()
+        if not self._drop_pending_savepoint(sid):
+            super(DelegatingDatabaseWrapper, self)._savepoint_rollback(sid)
+
+    def _savepoint_commit(self, sid):
+        if not self._drop_pending_savepoint(sid):
+            super(DelegatingDatabaseWrapper, self)._savepoint_commit(sid)
+
     def savepoint(self):
         return self.delegate.execute(super(DelegatingDatabaseWrapper, self).savepoint)
 
@@ -71,10 +588,10 @@ class DelegatingDatabaseWrapper(backends.BaseDatabaseWrapper):
         return self.delegate.execute(super(DelegatingDatabaseWrapper, self).savepoint_rollback, sid)
 
     def savepoint_commit(self, sid):
-        return self.delegate.execute(super(DelegatingDatabaseWrapper, self).savepoint_commit, sid)
+        self._execute_pipelined(super(DelegatingDatabaseWrapper, self).savepoint_commit, sid)
 
     def clean_savepoints(self):
-        return self.delegate.execute(super(DelegatingDatabaseWrapper, self).clean_savepoints)
+        self._execute_pipelined(super(DelegatingDatabaseWrapper, self).clean_savepoints)
 
 
 def make_wrapper(settings_dict, alias, **kwargs):
@@ -96,14 +613,108 @@ def make_wrapper(settings_dict, alias, **kwargs):
     class InnerDatabaseWrapper(DelegatingDatabaseWrapper, inner_engine_module.DatabaseWrapper):
         pass
 
-    return delegate.execute(InnerDatabaseWrapper, delegate, settings_dict, alias, **kwargs)
+    # Built on the calling thread: the delegate thread is only spawned on the
+    # first query; see validate_thread_sharing().
+    wrapper = InnerDatabaseWrapper(delegate, settings_dict, alias, **kwargs)
+    if settings_dict.get('SHAREDDB_TEST_TEMPLATE'):
+        # Imports models: only load it when needed.
+        from . import creation
+        wrapper.creation = creation.make_creation(wrapper)
+    return wrapper
+
+
+# Wrappers inherited from the parent process, after a fork; see reset_after_fork().
+_INHERITED_WRAPPERS = []
+
+
+def reset_after_fork(databases=None):
+    """Drop the delegates and wrappers inherited from the parent process.
+
+    Their threads don't survive fork(): in the child, new ones are built on
+    first use, optionally after updating the settings of some aliases from
+    ``databases`` (alias => settings), e.g. to use a cloned test database.
+
+    Called automatically in forked children where ``os.register_at_fork``
+    is available.
+    """
+    for delegate in DELEGATES.values():
+        delegate.abandon()
+    # Closing their connections would also close the parent's (e.g. psycopg2
+    # sends a Terminate message): keep them referenced instead.
+    _INHERITED_WRAPPERS.extend(SHARED_WRAPPERS.values())
+    DELEGATES.clear()
+    SHARED_WRAPPERS.clear()
+
+    for alias in connections.databases:
+        wrapper = getattr(connections._connections, alias, None)
+        if isinstance(wrapper, (DelegatingDatabaseWrapper, MirrorWrapper)):
+            delattr(connections._connections, alias)
+    for alias, alias_settings in (databases or {}).items():
+        connections.databases[alias].update(alias_settings)
+
+
+if register_at_fork is not None:
+    register_at_fork(after_in_child=reset_after_fork)
+
+
+def get_test_mirror(settings_dict):
+    """The alias a database mirrors in tests, if any."""
+    return settings_dict.get('TEST_MIRROR') or settings_dict.get('TEST', {}).get('MIRROR')
+
+
+def get_mirror(settings_dict):
+    """The alias a database mirrors in tests, if that one also uses the shareddb engine."""
+    mirror = get_test_mirror(settings_dict)
+    if mirror and connections.databases[mirror]['ENGINE'] == SHAREDDB_ENGINE:
+        return mirror
+    return None
+
+
+class MirrorWrapper(object):
+    """The wrapper of a test mirror, standing for the wrapper of the database it mirrors.
+
+    Everything - connection, delegate, transaction state - is shared with
+    that ``primary`` wrapper, except for ``alias`` and ``settings_dict``:
+    Django still sees the alias as a mirror (e.g. to load fixtures once).
+    """
+    OWN_ATTRIBUTES = ('primary', 'alias', 'settings_dict')
+
+    def __init__(self, primary, settings_dict, alias):
+        object.__setattr__(self, 'primary', primary)
+        object.__setattr__(self, 'settings_dict', settings_dict)
+        object.__setattr__(self, 'alias', alias)
+
+    def __getattr__(self, attr):
+        return getattr(self.primary, attr)
+
+    def __setattr__(self, attr, value):
+        if attr in self.OWN_ATTRIBUTES:
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self.primary, attr, value)
+
+    def __delattr__(self, attr):
+        if attr in self.OWN_ATTRIBUTES:
+            object.__delattr__(self, attr)
+        else:
+            delattr(self.primary, attr)
+
+    def __repr__(self):
+        return '<MirrorWrapper %r of %r>' % (self.alias, self.primary.alias)
 
 
 def DatabaseWrapper(settings_dict, alias, **kwargs):
     """Generate a DelegatingDatabaseWrapper for the given alias.
 
     Django expects this class to exist and to be callable.
+
+    Test mirrors share the wrapper - and thus the connection and transaction -
+    of the database they mirror, through a MirrorWrapper.
     """
     if alias not in SHARED_WRAPPERS:
-        SHARED_WRAPPERS[alias] = make_wrapper(settings_dict, alias, **kwargs)
+        mirror = get_mirror(settings_dict)
+        if mirror is not None:
+            SHARED_WRAPPERS[alias] = MirrorWrapper(connections[mirror], settings_dict, alias)
+        else:
+            SHARED_WRAPPERS[alias] = make_wrapper(settings_dict, alias, **kwargs)
     return SHARED_WRAPPERS[alias]
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Raphaël Barrois
+# This software is distributed under the two-clause BSD license.
+
+"""Reuse of test databases across runs, through templates keyed by a schema fingerprint.
+
+With ``SHAREDDB_TEST_TEMPLATE = True``, the first run creates the test database
+as usual (syncdb and flush), then keeps a copy of it - a PostgreSQL database
+or a SQLite file - named after a fingerprint of the schema. Later runs with the
+same fingerprint clone that copy instead of running syncdb again.
+"""
+
+
+import hashlib
+import os
+import shutil
+
+import django
+from django.conf import settings
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.db import models, router
+from django.utils.encoding import force_bytes
+
+
+def schema_fingerprint(connection):
+    """A digest of everything shaping a fresh test database for ``connection``.
+
+    Covers the Django version, the installed apps, and the SQL creating
+    the tables, indexes and custom SQL of all models synced to the database.
+    """
+    style = no_style()
+    creation = connection.creation
+    digest = hashlib.sha1()
+    digest.update(force_bytes(django.get_version()))
+    for app in settings.INSTALLED_APPS:
+        digest.update(force_bytes(app))
+
+    synced = [
+        model for model in models.get_models(include_auto_created=True)
+        if router.allow_syncdb(connection.alias, model)
+    ]
+    for model in sorted(synced, key=lambda model: model._meta.db_table):
+        statements, _references = creation.sql_create_model(model, style)
+        statements += creation.sql_indexes_for_model(model, style)
+        statements += custom_sql_for_model(model, style, connection)
+        for statement in statements:
+            digest.update(force_bytes(statement))
+    return digest.hexdigest()
+
+
+# Template stores
+# ===============
+
+
+class SQLiteTemplates(object):
+    """Keeps templates as copies of the test database file, next to it."""
+
+    def __init__(self, connection, test_database_name):
+        self.connection = connection
+        self.test_database_name = test_database_name
+
+    def _path(self, fingerprint):
+        return '%s.%s.template' % (self.test_database_name, fingerprint[:16])
+
+    def exists(self, fingerprint):
+        return os.path.exists(self._path(fingerprint))
+
+    def clone(self, fingerprint):
+        self.connection.close()
+        shutil.copyfile(self._path(fingerprint), self.test_database_name)
+
+    def save(self, fingerprint):
+        self.connection.close()
+        path = self._path(fingerprint)
+        # Templates for older schemas won't be used anymore.
+        directory, filename = os.path.split(os.path.abspath(self.test_database_name))
+        for other in os.listdir(directory):
+            if other.startswith(filename + '.') and other.endswith('.template'):
+                other = os.path.join(directory, other)
+                if other != os.path.abspath(path):
+                    os.remove(other)
+        shutil.copyfile(self.test_database_name, path)
+
+
+class PostgreSQLTemplates(object):
+    """Keeps templates as databases, cloned with ``CREATE DATABASE ... TEMPLATE``.
+
+    Statements are run while connected to the main database, like Django
+    does to create the test database.
+    """
+
+    def __init__(self, connection, test_database_name):
+        self.connection = connection
+        self.test_database_name = test_database_name
+        self.main_database_name = connection.settings_dict['NAME']
+
+    def _name(self, fingerprint):
+        # PostgreSQL truncates identifiers to 63 characters.
+        return '%s_tmpl_%s' % (self.test_database_name[:40], fingerprint[:16])
+
+    def _execute(self, *statements):
+        """Run statements from the main database, without using any other."""
+        connection = self.connection
+        test_database_name = connection.settings_dict['NAME']
+        connection.close()
+        connection.settings_dict['NAME'] = self.main_database_name
+        try:
+            cursor = connection.cursor()
+            for statement, params in statements:
+                cursor.execute(statement, params)
+            return cursor.fetchall() if cursor.description is not None else None
+        finally:
+            connection.close()
+            connection.settings_dict['NAME'] = test_database_name
+
+    def exists(self, fingerprint):
+        return bool(self._execute(
+            ("SELECT 1 FROM pg_database WHERE datname = %s", [self._name(fingerprint)])))
+
+    def clone(self, fingerprint):
+        qn = self.connection.ops.quote_name
+        self._execute(
+            ("DROP DATABASE IF EXISTS %s" % qn(self.test_database_name), None),
+            ("CREATE DATABASE %s TEMPLATE %s" % (qn(self.test_database_name), qn(self._name(fingerprint))), None),
+        )
+
+    def save(self, fingerprint):
+        qn = self.connection.ops.quote_name
+        name = self._name(fingerprint)
+        prefix = '%s_tmpl_' % self.test_database_name[:40]
+        stale = self._execute(
+            ("SELECT datname FROM pg_database WHERE datname LIKE %s AND datname != %s",
+                [prefix.replace('_', r'\_') + '%', name]))
+        self._execute(*(
+            [("DROP DATABASE %s" % qn(row[0]), None) for row in stale]
+            + [("CREATE DATABASE %s TEMPLATE %s" % (qn(name), qn(self.test_database_name)), None)]
+        ))
+
+
+TEMPLATE_STORES = {
+    'sqlite': SQLiteTemplates,
+    'postgresql': PostgreSQLTemplates,
+}
+
+
+def get_template_store(connection, test_database_name):
+    """The template store for a connection, or None if templates can't be used."""
+    if connection.vendor == 'sqlite' and test_database_name == ':memory:':
+        # Nothing to copy; creating those is fast anyway.
+        return None
+    store_class = TEMPLATE_STORES.get(connection.vendor)
+    if store_class is None:
+        return None
+    return store_class(connection, test_database_name)
+
+
+class TemplateCreationMixin(object):
+    """Mixed into the inner engine's DatabaseCreation, with SHAREDDB_TEST_TEMPLATE."""
+
+    def create_test_db(self, verbosity=1, autoclobber=False):
+        test_database_name = self._get_test_db_name()
+        store = get_template_store(self.connection, test_database_name)
+        if store is None:
+            return super(TemplateCreationMixin, self).create_test_db(verbosity, autoclobber)
+
+        fingerprint = schema_fingerprint(self.connection)
+        if not store.exists(fingerprint):
+            test_database_name = super(TemplateCreationMixin, self).create_test_db(verbosity, autoclobber)
+            store.save(fingerprint)
+            return test_database_name
+
+        if verbosity >= 1:
+            test_db_repr = ''
+            if verbosity >= 2:
+                test_db_repr = " ('%s')" % test_database_name
+            print("Cloning test database for alias '%s'%s from template %s..." % (
+                self.connection.alias, test_db_repr, fingerprint[:16]))
+        store.clone(fingerprint)
+
+        self.connection.close()
+        settings.DATABASES[self.connection.alias]["NAME"] = test_database_name
+        self.connection.settings_dict["NAME"] = test_database_name
+        # Like Django, initialize the test database right away.
+        self.connection.cursor()
+        return test_database_name
+
+
+def make_creation(connection):
+    """Wrap the DatabaseCreation of ``connection`` to reuse test database templates."""
+    inner_creation_class = type(connection.creation)
+
+    class TemplateCreation(TemplateCreationMixin, inner_creation_class):
+        pass
+
+    return TemplateCreation(connection)
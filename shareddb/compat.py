@@ -2,9 +2,47 @@
 # Copyright (c) 2014 Raphaël Barrois
 # This software is distributed under the two-clause BSD license.
 
+import multiprocessing
+import os
 import sys
+import threading
+import time
 
 if sys.version_info[0] < 3:
     import Queue as queue
+    from thread import get_ident
 else:
     import queue
+    from threading import get_ident
+
+
+def main_thread():
+    if hasattr(threading, 'main_thread'):
+        return threading.main_thread()
+    for thread in threading.enumerate():
+        if isinstance(thread, threading._MainThread):
+            return thread
+
+
+# Monotonic, high-resolution clock where available
+timer = getattr(time, 'perf_counter', time.time)
+
+try:
+    from concurrent import futures
+except ImportError:  # Python 2, without the 'futures' backport
+    futures = None
+
+try:
+    import asyncio
+except ImportError:  # Python < 3.4
+    asyncio = None
+
+# Python 3.7+; elsewhere, fork handlers must be called explicitly.
+register_at_fork = getattr(os, 'register_at_fork', None)
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Raphaël Barrois
+# This software is distributed under the two-clause BSD license.
+
+"""pytest plugin for shareddb, on top of pytest-django.
+
+- With ``--shareddb`` (or ``shareddb = true`` in the ini file), all databases
+  are wrapped with the shareddb engine through ``shareddb.patch_databases``
+- ``shared_live_server`` provides a live server sharing the test's transaction:
+  unlike pytest-django's ``live_server``, it works with the ``db`` fixture,
+  and data is rolled back after each test instead of flushed
+- ``shareddb_stats`` and ``shareddb_queries`` expose delegate statistics
+  and the queries run from all threads during the test
+"""
+
+
+import sys
+
+import pytest
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('shareddb')
+    group.addoption('--shareddb', action='store_true', dest='shareddb', default=None,
+        help="Wrap all databases with the shareddb engine.")
+    parser.addini('shareddb', type='bool', default=False,
+        help="Wrap all databases with the shareddb engine.")
+
+
+def _is_enabled(config):
+    if config.getoption('shareddb'):
+        return True
+    return config.getini('shareddb')
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    if not _is_enabled(config):
+        return
+
+    from django.conf import settings
+    from django.db import connections
+    import shareddb
+
+    # Aliases already using shareddb (e.g. through patch_databases in the
+    # settings) are left alone.
+    wrapped = [
+        alias for alias, alias_settings in settings.DATABASES.items()
+        if alias_settings.get('ENGINE') == shareddb.SHAREDDB_ENGINE
+    ]
+    # Django may already have loaded its database settings (e.g. when importing
+    # models): update them in place, and drop any wrapper built from them.
+    patched = shareddb.patch_databases(settings.DATABASES, blacklist=wrapped)
+    for alias in wrapped:
+        del patched[alias]
+    for alias, alias_settings in patched.items():
+        settings.DATABASES[alias].update(alias_settings)
+        if hasattr(connections._connections, alias):
+            delattr(connections._connections, alias)
+
+
+def pytest_unconfigure(config):
+    # Don't import Django-dependent modules unless they were already used.
+    if 'shareddb.testcase' in sys.modules:
+        from shareddb import testcase
+        testcase.stop_shared_server_thread()
+    if 'shareddb.backends.shareddb.base' in sys.modules:
+        from shareddb.backends.shareddb import base
+        base.shutdown_delegates()
+
+
+def pytest_terminal_summary(terminalreporter):
+    if 'shareddb.testcase' not in sys.modules:
+        return
+    from shareddb import testcase
+    report = testcase.stats_report()
+    if report:
+        terminalreporter.write_sep('-', "shareddb")
+        for line in report:
+            terminalreporter.write_line(line)
+
+
+class SharedLiveServer(object):
+    """The shared live server, as seen from a test."""
+    def __init__(self, thread):
+        self.thread = thread
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % (self.thread.host, self.thread.port)
+
+    def __str__(self):
+        return self.url
+
+    def __add__(self, other):
+        return self.url + other
+
+
+@pytest.fixture
+def shared_live_server(db):
+    """A live server, started once per session, seeing the test's transaction."""
+    from shareddb import testcase
+    return SharedLiveServer(testcase.get_shared_server_thread())
+
+
+@pytest.fixture
+def shareddb_stats():
+    """The DelegateStats of each alias collecting them (``SHAREDDB_STATS``), by alias."""
+    from shareddb.backends.shareddb import base
+    return dict(
+        (alias, delegate.stats)
+        for alias, delegate in base.DELEGATES.items()
+        if delegate.stats is not None
+    )
+
+
+@pytest.fixture
+def shareddb_queries(db):
+    """A QueryCapture of the default database, for the duration of the test."""
+    from shareddb import testcase
+    with testcase.QueryCapture() as capture:
+        yield capture
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Raphaël Barrois
+# This software is distributed under the two-clause BSD license.
+
+"""Share a delegated connection with other processes, over a Unix-domain socket.
+
+The test process runs a DelegateServer for a shareddb alias; worker processes
+use the ``shareddb.backends.remote`` engine, pointing at the same socket,
+and run all their statements within the test process' transaction.
+
+Messages are pickled: the socket must only be reachable by trusted processes.
+It is created with 0600 permissions.
+"""
+
+
+import logging
+import os
+import pickle
+import socket
+import struct
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
+
+from .backends.shareddb import base
+
+logger = logging.getLogger(__name__)
+
+
+# Wire protocol
+# =============
+
+HEADER = struct.Struct('!I')
+PICKLE_PROTOCOL = 2  # Readable by both Python 2 and 3.
+
+
+class RemoteError(Exception):
+    """Raised when the remote peer misbehaves or disappears."""
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise RemoteError("Connection closed by peer")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_message(sock, message):
+    payload = pickle.dumps(message, PICKLE_PROTOCOL)
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def recv_message(sock):
+    size, = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    return pickle.loads(_recv_exactly(sock, size))
+
+
+def _pickle_exception(exception):
+    """Prepare an exception for sending, as (pickled exception or None, message)."""
+    try:
+        return pickle.dumps(exception, PICKLE_PROTOCOL), str(exception)
+    except Exception:
+        return None, '%s: %s' % (exception.__class__.__name__, exception)
+
+
+# Server side
+# ===========
+
+class RemoteSession(threading.Thread):
+    """Handles the requests of one remote connection.
+
+    Remote cursors map to cursors on the shared connection. Remote transactions
+    can't commit the shared transaction; they are emulated with a savepoint,
+    opened on the first statement run outside autocommit mode.
+    """
+    def __init__(self, server, sock, name=None):
+        super(RemoteSession, self).__init__(name=name)
+        self.server = server
+        self.sock = sock
+        self.cursors = {}
+        self.next_cursor_id = 1
+        self.autocommit = True
+        self.savepoint = None
+        self.in_transaction = False
+
+    @property
+    def wrapper(self):
+        return connections[self.server.alias]
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    request = recv_message(self.sock)
+                except (RemoteError, socket.error):
+                    break
+                op, args = request
+                try:
+                    result = getattr(self, 'op_%s' % op)(*args)
+                except Exception as e:
+                    pickled, message = _pickle_exception(e)
+                    send_message(self.sock, ('error', pickled, message))
+                else:
+                    send_message(self.sock, ('ok', result))
+                if op == 'close':
+                    break
+        finally:
+            self._end_transaction(commit=False)
+            self.sock.close()
+            self.server.sessions.discard(self)
+
+    # Transactions
+    # ============
+
+    def _begin_transaction(self):
+        if self.in_transaction:
+            return
+        sid = self.wrapper.savepoint()
+        if sid is None:
+            # Without savepoints, a rollback couldn't undo anything.
+            raise transaction.TransactionManagementError(
+                "Remote transactions require database %r to be within a transaction "
+                "using savepoints, e.g. in a test case." % self.server.alias)
+        self.savepoint = sid
+        self.in_transaction = True
+
+    def _end_transaction(self, commit):
+        if not self.in_transaction:
+            return
+        self.in_transaction = False
+        sid, self.savepoint = self.savepoint, None
+        if not commit:
+            self.wrapper.savepoint_rollback(sid)
+        self.wrapper.savepoint_commit(sid)
+
+    def op_set_autocommit(self, autocommit):
+        self.autocommit = autocommit
+        if autocommit:
+            self._end_transaction(commit=True)
+
+    def op_begin(self):
+        self._begin_transaction()
+
+    def op_commit(self):
+        self._end_transaction(commit=True)
+
+    def op_rollback(self):
+        self._end_transaction(commit=False)
+
+    def op_ping(self):
+        return True
+
+    def op_close(self):
+        self._end_transaction(commit=False)
+        for cursor in self.cursors.values():
+            cursor.close()
+        self.cursors.clear()
+
+    # Cursors
+    # =======
+
+    def op_cursor(self):
+        wrapper = self.wrapper
+        cursor = wrapper.delegate.execute(wrapper._cursor)
+        cursor_id = self.next_cursor_id
+        self.next_cursor_id += 1
+        self.cursors[cursor_id] = cursor
+        return cursor_id
+
+    def _statement_result(self, cursor):
+        description = cursor.description
+        if description is None:
+            rows, exhausted = [], True
+        else:
+            description = [tuple(column) for column in description]
+            # Send a first batch of rows along with the statement result.
+            rows = cursor.fetchmany(self.server.fetch_size)
+            exhausted = len(rows) < self.server.fetch_size
+        return (description, cursor.rowcount, getattr(cursor, 'lastrowid', None), list(rows), exhausted)
+
+    def op_execute(self, cursor_id, sql, params):
+        if not self.autocommit:
+            self._begin_transaction()
+        cursor = self.cursors[cursor_id]
+        cursor.execute(sql, params)
+        return self._statement_result(cursor)
+
+    def op_executemany(self, cursor_id, sql, param_list):
+        if not self.autocommit:
+            self._begin_transaction()
+        cursor = self.cursors[cursor_id]
+        cursor.executemany(sql, param_list)
+        return self._statement_result(cursor)
+
+    def op_fetchmany(self, cursor_id, size):
+        return list(self.cursors[cursor_id].fetchmany(size))
+
+    def op_fetchall(self, cursor_id):
+        return list(self.cursors[cursor_id].fetchall())
+
+    def op_close_cursor(self, cursor_id):
+        self.cursors.pop(cursor_id).close()
+
+
+class DelegateServer(object):
+    """Serves the shared connection of a shareddb alias on a Unix-domain socket.
+
+    Usage:
+
+        >>> server = remote.DelegateServer('default', '/tmp/shareddb/default.sock')
+        >>> server.start()
+        >>> # Start workers using the shareddb.backends.remote engine
+        >>> server.stop()
+    """
+
+    def __init__(self, alias, path, fetch_size=None):
+        wrapper = connections[alias]
+        if not isinstance(wrapper, base.DelegatingDatabaseWrapper):
+            raise ImproperlyConfigured(
+                "Database %r must use the shareddb engine to be served to other processes." % alias)
+        self.alias = alias
+        self.path = path
+        self.fetch_size = fetch_size or wrapper.fetch_size
+        self.sock = None
+        self.accept_thread = None
+        self.sessions = set()
+
+    def start(self):
+        assert self.sock is None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(16)
+        self.sock = sock
+
+        self.accept_thread = threading.Thread(target=self._accept, name='shareddb-server-%s' % self.alias)
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+        logger.debug("Serving database %s on %s", self.alias, self.path)
+
+    def _accept(self):
+        count = 0
+        while True:
+            try:
+                client, _address = self.sock.accept()
+            except (socket.error, AttributeError):
+                # Listening socket closed
+                break
+            count += 1
+            session = RemoteSession(self, client, name='shareddb-session-%s-%d' % (self.alias, count))
+            session.daemon = True
+            self.sessions.add(session)
+            session.start()
+
+    def stop(self):
+        assert self.sock is not None
+        sock, self.sock = self.sock, None
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+        self.accept_thread.join()
+        for session in list(self.sessions):
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            session.join()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+# Client side
+# ===========
+
+class RemoteConnection(object):
+    """A DB-API connection lookalike, forwarding calls to a DelegateServer.
+
+    ``database`` is the DB-API module of the inner engine, used to report
+    errors that couldn't be transmitted as-is.
+    """
+    def __init__(self, path, database, fetch_size):
+        self.path = path
+        self.database = database
+        self.fetch_size = fetch_size
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.lock = threading.Lock()
+
+    def call(self, op, *args):
+        with self.lock:
+            if self.sock is None:
+                raise self.database.InterfaceError("Connection already closed")
+            send_message(self.sock, (op, args))
+            response = recv_message(self.sock)
+        if response[0] == 'ok':
+            return response[1]
+        _status, pickled, message = response
+        if pickled is not None:
+            raise pickle.loads(pickled)
+        raise self.database.DatabaseError(message)
+
+    def cursor(self):
+        return RemoteCursor(self, self.call('cursor'))
+
+    def set_autocommit(self, autocommit):
+        self.call('set_autocommit', autocommit)
+
+    def begin(self):
+        self.call('begin')
+
+    def commit(self):
+        self.call('commit')
+
+    def rollback(self):
+        self.call('rollback')
+
+    def ping(self):
+        return self.call('ping')
+
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            self.call('close')
+        finally:
+            self.sock.close()
+            self.sock = None
+
+
+class RemoteCursor(base.PrefetchingCursor):
+    """A DB-API cursor lookalike, running statements through a RemoteConnection.
+
+    The first rows of a result are sent along with the statement's result;
+    further rows are fetched in chunks of ``connection.fetch_size``.
+    """
+    arraysize = 1
+
+    def __init__(self, connection, cursor_id):
+        super(RemoteCursor, self).__init__(fetch_size=connection.fetch_size)
+        self.connection = connection
+        self.cursor_id = cursor_id
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def _run_statement(self, op, sql, params):
+        self._reset()
+        self.description, self.rowcount, self.lastrowid, rows, exhausted = self.connection.call(
+            op, self.cursor_id, sql, params)
+        self._reset(rows, exhausted)
+
+    def execute(self, sql, params=None):
+        self._run_statement('execute', sql, params)
+
+    def executemany(self, sql, param_list):
+        self._run_statement('executemany', sql, list(param_list))
+
+    def _fetch_chunk(self, size):
+        return self.connection.call('fetchmany', self.cursor_id, size)
+
+    def _fetch_remaining(self):
+        return self.connection.call('fetchall', self.cursor_id)
+
+    def close(self):
+        if self.connection.sock is not None:
+            self.connection.call('close_cursor', self.cursor_id)
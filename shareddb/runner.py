@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Raphaël Barrois
+# This software is distributed under the two-clause BSD license.
+
+import sys
+
+from django.test import runner
+
+from . import testcase
+from .backends.shareddb import base
+
+
+class DiscoverRunner(runner.DiscoverRunner):
+    """A DiscoverRunner cleaning up after shareddb at the end of the run.
+
+    - Stops the shared live server, if any
+    - Stops the delegate threads
+    - Prints delegate stats, for aliases with ``SHAREDDB_STATS = True``
+    """
+    def teardown_test_environment(self, **kwargs):
+        testcase.stop_shared_server_thread()
+        base.shutdown_delegates()
+        super(DiscoverRunner, self).teardown_test_environment(**kwargs)
+        report = testcase.stats_report()
+        if report:
+            sys.stderr.write('\n'.join(report) + '\n')
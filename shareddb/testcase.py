@@ -2,16 +2,440 @@
 # Copyright (c) 2014 Raphaël Barrois
 # This software is distributed under the two-clause BSD license.
 
+import atexit
+import collections
+import errno
 import logging
+import math
 import os
+import socket
 import sys
+import threading
 
+from django.conf import settings
 from django.core import exceptions
+from django.core.management import call_command
+from django.core.servers import basehttp
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
 from django.test import testcases
 from django.utils import six
+from django.utils.six.moves.urllib import request as urllib_request
+
+from . import compat
+from . import threlegate
+from .backends.shareddb import base
 
 logger = logging.getLogger(__name__)
 
+
+# Delegated work per test class, as {'module.Class': [tasks, wait, run]}.
+# Only filled for aliases with SHAREDDB_STATS enabled.
+CLASS_STATS = collections.defaultdict(lambda: [0, 0.0, 0.0])
+
+
+def get_stats_totals():
+    """Fetch the current (tasks, wait, run) totals of all aliases collecting stats."""
+    return dict(
+        (alias, delegate.stats.totals())
+        for alias, delegate in base.DELEGATES.items()
+        if delegate.stats is not None
+    )
+
+
+def record_class_stats(label, start_totals):
+    """Add the work done by all delegates since start_totals to a test class."""
+    class_stats = CLASS_STATS[label]
+    for alias, totals in get_stats_totals().items():
+        start = start_totals.get(alias, (0, 0.0, 0.0))
+        for i, (current, previous) in enumerate(zip(totals, start)):
+            class_stats[i] += current - previous
+
+
+def stats_report(top=10):
+    """Summarize collected stats, per alias and for the most expensive test classes.
+
+    Only configured aliases that ran some tasks are listed, and only shareddb's
+    LiveServerTestCase subclasses are attributed per class.
+
+    Returns a list of lines; empty if no alias collects stats.
+    """
+    lines = []
+    for alias, delegate in sorted(base.DELEGATES.items()):
+        if alias not in settings.DATABASES or delegate.stats is None or not delegate.stats.tasks:
+            continue
+        lines.append("shareddb stats for %r:" % alias)
+        lines.extend("  %s" % line for line in delegate.stats.summary())
+
+    if CLASS_STATS:
+        lines.append("LiveServerTestCase classes by serialized time (wait + run; other test classes not attributed):")
+        by_time = sorted(CLASS_STATS.items(), key=lambda item: item[1][1] + item[1][2], reverse=True)
+        for label, (tasks, wait, run) in by_time[:top]:
+            lines.append("  %8.3fs  %s (%d tasks, %.3fs waiting, %.3fs running)" % (
+                wait + run, label, tasks, wait, run))
+    return lines
+
+
+# Django 1.7+ dropped StoppableWSGIServer, and serves live tests with a plain WSGIServer.
+_BaseWSGIServer = getattr(testcases, 'StoppableWSGIServer', basehttp.WSGIServer)
+
+
+class PooledWSGIServer(_BaseWSGIServer):
+    """A live server handling requests on a pool of ``threads`` handler threads."""
+
+    def __init__(self, *args, **kwargs):
+        threads = kwargs.pop('threads')
+        self.pending = compat.queue.Queue()
+        # Set first: server_close() is called if binding the port fails.
+        self.workers = []
+        super(PooledWSGIServer, self).__init__(*args, **kwargs)
+        for i in range(threads):
+            worker = threading.Thread(target=self._work, name='live-server-%d' % (i + 1))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
+    def _work(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super(PooledWSGIServer, self).server_close()
+        for _worker in self.workers:
+            self.pending.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class PooledLiveServerThread(testcases.LiveServerThread):
+    """A LiveServerThread serving requests with a PooledWSGIServer."""
+
+    def __init__(self, host, possible_ports, connections_override=None, threads=1):
+        self.threads = threads
+        super(PooledLiveServerThread, self).__init__(host, possible_ports, connections_override)
+
+    def run(self):
+        # Same as LiveServerThread.run(), with another server class.
+        if self.connections_override:
+            for alias, conn in self.connections_override.items():
+                connections[alias] = conn
+        try:
+            handler = testcases.StaticFilesHandler(testcases._MediaFilesHandler(testcases.WSGIHandler()))
+            for index, port in enumerate(self.possible_ports):
+                try:
+                    self.httpd = PooledWSGIServer(
+                        (self.host, port), testcases.QuietWSGIRequestHandler, threads=self.threads)
+                except socket.error as e:
+                    if index + 1 < len(self.possible_ports) and e.errno == errno.EADDRINUSE:
+                        continue
+                    raise
+                else:
+                    self.port = port
+                    break
+
+            self.httpd.set_app(handler)
+            self.is_ready.set()
+            self.httpd.serve_forever()
+        except Exception as e:
+            self.error = e
+            self.is_ready.set()
+
+
+def get_live_server_threads():
+    """Number of request handler threads for live servers, from SHAREDDB_LIVE_SERVER_THREADS."""
+    return getattr(settings, 'SHAREDDB_LIVE_SERVER_THREADS', 1)
+
+
+def start_server_thread(threads=1):
+    """Start a LiveServerThread, and wait until it is ready to handle requests.
+
+    The server listens on the first available port from the
+    DJANGO_LIVE_TEST_SERVER_ADDRESS environment variable; with ``threads``
+    above 1, it handles requests on that many threads.
+    """
+    specified_address = os.environ.get(
+        'DJANGO_LIVE_TEST_SERVER_ADDRESS', 'localhost:8081')
+
+    # The specified ports may be of the form '8000-8010,8080,9200-9300'
+    # i.e. a comma-separated list of ports or ranges of ports, so we break
+    # it down into a detailed list of all possible ports.
+    possible_ports = []
+    try:
+        host, port_ranges = specified_address.split(':')
+        for port_range in port_ranges.split(','):
+            # A port range can be of either form: '8000' or '8000-8010'.
+            extremes = list(map(int, port_range.split('-')))
+            assert len(extremes) in [1, 2]
+            if len(extremes) == 1:
+                # Port range of the form '8000'
+                possible_ports.append(extremes[0])
+            else:
+                # Port range of the form '8000-8010'
+                for port in range(extremes[0], extremes[1] + 1):
+                    possible_ports.append(port)
+    except Exception:
+        msg = 'Invalid address ("%s") for live server.' % specified_address
+        six.reraise(exceptions.ImproperlyConfigured, exceptions.ImproperlyConfigured(msg), sys.exc_info()[2])
+    if threads > 1:
+        server_thread = PooledLiveServerThread(host, possible_ports, {}, threads=threads)
+    else:
+        server_thread = testcases.LiveServerThread(host, possible_ports, {})
+    server_thread.daemon = True
+    server_thread.start()
+    logger.debug("Started LiveServerThread %d", server_thread.ident)
+
+    # Wait for the live server to be ready
+    server_thread.is_ready.wait()
+    if server_thread.error:
+        server_thread.join()
+        raise server_thread.error
+    return server_thread
+
+
+# The live server shared across test classes, started on first use.
+SHARED_SERVER_THREAD = None
+_shared_server_lock = threading.Lock()
+
+
+def get_shared_server_thread():
+    """Retrieve the shared live server, starting it if needed."""
+    global SHARED_SERVER_THREAD
+    with _shared_server_lock:
+        if SHARED_SERVER_THREAD is None:
+            SHARED_SERVER_THREAD = start_server_thread(get_live_server_threads())
+            atexit.register(stop_shared_server_thread)
+        return SHARED_SERVER_THREAD
+
+
+def reset_shared_server_after_fork():
+    """Forget the shared live server inherited from the parent process."""
+    global SHARED_SERVER_THREAD, _shared_server_lock
+    SHARED_SERVER_THREAD = None
+    _shared_server_lock = threading.Lock()
+
+
+if compat.register_at_fork is not None:
+    compat.register_at_fork(after_in_child=reset_shared_server_after_fork)
+
+
+def stop_shared_server_thread():
+    """Stop the shared live server, if running."""
+    global SHARED_SERVER_THREAD
+    with _shared_server_lock:
+        if SHARED_SERVER_THREAD is not None:
+            SHARED_SERVER_THREAD.join()
+            SHARED_SERVER_THREAD = None
+
+
+def run_per_database(db_names, function, stop_on_error=True):
+    """Call ``function(db_name)`` for each database.
+
+    Calls for databases sharing a delegate run in a single batch on it, so that
+    the connection calls they issue don't each cost a thread hop.
+    """
+    batches = collections.OrderedDict()
+    for db_name in db_names:
+        delegate = getattr(connections[db_name], 'delegate', None)
+        batches.setdefault(delegate, []).append((function, (db_name,), {}))
+
+    for delegate, calls in batches.items():
+        if delegate is None:
+            threlegate.run_batch(calls, stop_on_error)
+        else:
+            delegate.execute_batch(calls, stop_on_error)
+
+
+class QueryCapture(object):
+    """Context manager recording queries run on a shareddb connection, from any thread.
+
+    Each captured query is a dict, as described in DelegatingCursor.
+
+    Usage:
+
+        >>> with QueryCapture(exclude_thread=threading.current_thread()) as queries:
+        ...     requests.get(live_server_url)
+        >>> len(queries)
+        3
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, exclude_thread=None):
+        self.using = using
+        self.exclude_thread = exclude_thread
+        self.captured_queries = []
+        self._lock = threading.Lock()
+
+    def record(self, query):
+        if query['thread'] is self.exclude_thread:
+            return
+        with self._lock:
+            self.captured_queries.append(query)
+
+    def __enter__(self):
+        connection = connections[self.using]
+        if not hasattr(connection, 'query_listeners'):
+            raise exceptions.ImproperlyConfigured(
+                "Query capture requires the %r database to use the shareddb engine." % self.using)
+        self.captured_queries = []
+        connection.query_listeners.append(self.record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connections[self.using].query_listeners.remove(self.record)
+
+    def __len__(self):
+        return len(self.captured_queries)
+
+    def __iter__(self):
+        return iter(self.captured_queries)
+
+    def __getitem__(self, index):
+        return self.captured_queries[index]
+
+    def describe(self):
+        return '\n'.join(
+            "%d. [%s] %s" % (i, query['thread'].name, query['sql'])
+            for i, query in enumerate(self.captured_queries, start=1)
+        )
+
+
+class _AssertServerQueriesContext(QueryCapture):
+    """Check the number of queries run outside the test thread."""
+
+    def __init__(self, test_case, num, using, maximum=False):
+        self.test_case = test_case
+        self.num = num
+        self.maximum = maximum
+        super(_AssertServerQueriesContext, self).__init__(using, exclude_thread=threading.current_thread())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(_AssertServerQueriesContext, self).__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            return
+        executed = len(self)
+        if self.maximum:
+            self.test_case.assertLessEqual(
+                executed, self.num, "%d queries executed, at most %d expected:\n%s" % (
+                    executed, self.num, self.describe()))
+        else:
+            self.test_case.assertEqual(
+                executed, self.num, "%d queries executed, %d expected:\n%s" % (
+                    executed, self.num, self.describe()))
+
+
+# Load generation
+# ===============
+
+
+def percentile(values, percent):
+    """The nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+class LoadResult(object):
+    """Outcome of run_load().
+
+    Attributes:
+        requests (int): number of requests sent
+        errors (int): number of failed requests
+        elapsed (float): duration of the run, in seconds
+        durations (float list): duration of each request, in seconds
+        delegate_tasks (int): calls run on the database's delegate during the run
+        delegate_wait (float): time those calls spent waiting for the shared
+            connection, in seconds; both are None unless SHAREDDB_STATS is enabled
+    """
+
+    def __init__(self, durations, errors, elapsed, delegate_tasks=None, delegate_wait=None):
+        self.durations = durations
+        self.requests = len(durations)
+        self.errors = errors
+        self.elapsed = elapsed
+        self.delegate_tasks = delegate_tasks
+        self.delegate_wait = delegate_wait
+
+    @property
+    def throughput(self):
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def p50(self):
+        return percentile(self.durations, 50)
+
+    @property
+    def p99(self):
+        return percentile(self.durations, 99)
+
+    def summary(self):
+        """A human-readable summary, as a list of lines."""
+        lines = [
+            "%d requests (%d errors) in %.3fs: %.1f requests/s" % (
+                self.requests, self.errors, self.elapsed, self.throughput),
+            "latency: p50=%.2fms p99=%.2fms" % (self.p50 * 1e3, self.p99 * 1e3),
+        ]
+        if self.delegate_tasks is not None:
+            lines.append("delegate: %d tasks, %.3fs waiting (%.1fus/task, %.2fms/request)" % (
+                self.delegate_tasks, self.delegate_wait,
+                self.delegate_wait / self.delegate_tasks * 1e6 if self.delegate_tasks else 0.0,
+                self.delegate_wait / self.requests * 1e3 if self.requests else 0.0))
+        return lines
+
+
+def run_load(url, clients=10, requests=100, using=DEFAULT_DB_ALIAS):
+    """Send ``requests`` GET requests to ``url`` from ``clients`` concurrent threads.
+
+    Returns a LoadResult; the delegate wait is that of the ``using`` database.
+    """
+    durations = []
+    errors = []
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            start = compat.timer()
+            try:
+                urllib_request.urlopen(url).read()
+            except Exception as e:
+                errors.append(e)
+            durations.append(compat.timer() - start)
+
+    delegate = getattr(connections[using], 'delegate', None)
+    stats = delegate.stats if delegate is not None else None
+    before = stats.totals() if stats is not None else None
+    threads = [threading.Thread(target=client, name='load-client-%d' % (i + 1)) for i in range(clients)]
+    start = compat.timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = compat.timer() - start
+
+    if errors:
+        logger.warning("%d of %d requests to %s failed; first error: %r", len(errors), requests, url, errors[0])
+    if stats is None:
+        return LoadResult(durations, len(errors), elapsed)
+    tasks, wait, _run = [after - prev for after, prev in zip(stats.totals(), before)]
+    return LoadResult(durations, len(errors), elapsed, delegate_tasks=tasks, delegate_wait=wait)
+
+
 class LiveServerTestCase(testcases.TestCase):
     """
     Does basically the same as TransactionTestCase but also launches a live
@@ -22,63 +446,167 @@ class LiveServerTestCase(testcases.TestCase):
     the threads do not share the same transactions (unless if using in-memory
     sqlite) and each thread needs to commit all their transactions so that the
     other thread can see the changes.
+
+    With ``shared_live_server = True`` (defaults to the SHAREDDB_SHARED_LIVE_SERVER
+    setting), all test classes use a single live server, started on first use.
+
+    With ``live_server_threads`` (defaults to the SHAREDDB_LIVE_SERVER_THREADS
+    setting) above 1, the live server handles requests on that many threads;
+    ``run_load()`` measures how it copes with concurrent clients.
+
+    Fixtures, and data created in ``setUpTestData()``, are loaded once per class
+    in a class-wide transaction; each test then runs within a savepoint, rolled
+    back at the end of the test.
     """
 
+    shared_live_server = None
+    # Request handler threads of the class' own live server; see get_live_server_threads().
+    live_server_threads = None
+
+    def assertNumServerQueries(self, num, func=None, *args, **kwargs):
+        """Like assertNumQueries, counting queries from all threads but the test thread.
+
+        This catches queries run by the live server while handling requests.
+        """
+        using = kwargs.pop('using', DEFAULT_DB_ALIAS)
+        context = _AssertServerQueriesContext(self, num, using)
+        if func is None:
+            return context
+
+        with context:
+            func(*args, **kwargs)
+
+    def assertMaxServerQueries(self, num, func=None, *args, **kwargs):
+        """Like assertNumServerQueries, but accepts up to ``num`` queries."""
+        using = kwargs.pop('using', DEFAULT_DB_ALIAS)
+        context = _AssertServerQueriesContext(self, num, using, maximum=True)
+        if func is None:
+            return context
+
+        with context:
+            func(*args, **kwargs)
+
+    def run_load(self, path='/', clients=10, requests=100, using=DEFAULT_DB_ALIAS):
+        """Load the live server with concurrent requests to ``path``; see run_load()."""
+        return run_load(self.live_server_url + path, clients=clients, requests=requests, using=using)
+
     @property
     def live_server_url(self):
         return 'http://%s:%s' % (
             self.server_thread.host, self.server_thread.port)
 
+    @classmethod
+    def _use_shared_live_server(cls):
+        if cls.shared_live_server is None:
+            return getattr(settings, 'SHAREDDB_SHARED_LIVE_SERVER', False)
+        return cls.shared_live_server
+
     @classmethod
     def setUpClass(cls):
         # Launch the live server's thread
-        specified_address = os.environ.get(
-            'DJANGO_LIVE_TEST_SERVER_ADDRESS', 'localhost:8081')
-
-        # The specified ports may be of the form '8000-8010,8080,9200-9300'
-        # i.e. a comma-separated list of ports or ranges of ports, so we break
-        # it down into a detailed list of all possible ports.
-        possible_ports = []
-        try:
-            host, port_ranges = specified_address.split(':')
-            for port_range in port_ranges.split(','):
-                # A port range can be of either form: '8000' or '8000-8010'.
-                extremes = list(map(int, port_range.split('-')))
-                assert len(extremes) in [1, 2]
-                if len(extremes) == 1:
-                    # Port range of the form '8000'
-                    possible_ports.append(extremes[0])
-                else:
-                    # Port range of the form '8000-8010'
-                    for port in range(extremes[0], extremes[1] + 1):
-                        possible_ports.append(port)
-        except Exception:
-            msg = 'Invalid address ("%s") for live server.' % specified_address
-            six.reraise(exceptions.ImproperlyConfigured, exceptions.ImproperlyConfigured(msg), sys.exc_info()[2])
-        cls.server_thread = testcases.LiveServerThread(
-            host, possible_ports, {})
-        cls.server_thread.daemon = True
-        cls.server_thread.start()
-        logger.debug("Started LiveServerThread %d", cls.server_thread.ident)
-
-        # Wait for the live server to be ready
-        cls.server_thread.is_ready.wait()
-        if cls.server_thread.error:
-            # Clean up behind ourselves, since tearDownClass won't get called in
-            # case of errors.
-            cls._tearDownClassInternal()
-            raise cls.server_thread.error
+        if cls._use_shared_live_server():
+            cls.server_thread = get_shared_server_thread()
+            cls._owns_server_thread = False
+        else:
+            threads = cls.live_server_threads
+            if threads is None:
+                threads = get_live_server_threads()
+            cls.server_thread = start_server_thread(threads)
+            cls._owns_server_thread = True
 
+        cls._stats_totals = get_stats_totals()
         super(LiveServerTestCase, cls).setUpClass()
 
+        if testcases.connections_support_transactions():
+            cls.cls_atomics = cls._enter_atomics()
+            try:
+                cls._load_class_fixtures()
+                cls.setUpTestData()
+            except Exception:
+                cls._rollback_atomics(cls.cls_atomics)
+                del cls.cls_atomics
+                cls._tearDownClassInternal()
+                raise
+
+    @classmethod
+    def setUpTestData(cls):
+        """Load class-wide test data; restored to that state before each test."""
+        pass
+
+    @classmethod
+    def _class_databases_names(cls, include_mirrors=True):
+        # Same as TransactionTestCase._databases_names(), at the class level.
+        if getattr(cls, 'multi_db', False):
+            return [alias for alias in connections
+                    if include_mirrors or not base.get_test_mirror(connections.databases[alias])]
+        else:
+            return [DEFAULT_DB_ALIAS]
+
+    @classmethod
+    def _enter_atomics(cls):
+        """Open an atomic block for each database; nested calls create savepoints."""
+        atomics = {}
+
+        def enter(db_name):
+            atomics[db_name] = transaction.atomic(using=db_name)
+            atomics[db_name].__enter__()
+
+        run_per_database(cls._class_databases_names(), enter)
+        return atomics
+
+    @classmethod
+    def _rollback_atomics(cls, atomics):
+        def rollback(db_name):
+            # Hack to force a rollback
+            connections[db_name].needs_rollback = True
+            atomics[db_name].__exit__(None, None, None)
+
+        run_per_database(reversed(cls._class_databases_names()), rollback, stop_on_error=False)
+
+    @classmethod
+    def _load_class_fixtures(cls):
+        if not hasattr(cls, 'fixtures'):
+            return
+        for db_name in cls._class_databases_names(include_mirrors=False):
+            call_command('loaddata', *cls.fixtures, **{
+                'verbosity': 0,
+                'commit': False,
+                'database': db_name,
+                'skip_validation': True,
+            })
+
+    def _fixture_setup(self):
+        if not testcases.connections_support_transactions():
+            super(LiveServerTestCase, self)._fixture_setup()
+            self.setUpTestData()
+            return
+
+        # Fixtures were loaded in setUpClass(): just take a savepoint.
+        self.atomics = self._enter_atomics()
+        # Remove this when the legacy transaction management goes away.
+        testcases.disable_transaction_methods()
+
+    def _fixture_teardown(self):
+        if not testcases.connections_support_transactions():
+            return super(LiveServerTestCase, self)._fixture_teardown()
+
+        # Remove this when the legacy transaction management goes away.
+        testcases.restore_transaction_methods()
+        self._rollback_atomics(self.atomics)
+
     @classmethod
     def _tearDownClassInternal(cls):
         # There may not be a 'server_thread' attribute if setUpClass() for some
         # reasons has raised an exception.
-        if hasattr(cls, 'server_thread'):
+        if hasattr(cls, 'server_thread') and cls._owns_server_thread:
             # Terminate the live server's thread
             cls.server_thread.join()
 
     @classmethod
     def tearDownClass(cls):
+        if hasattr(cls, 'cls_atomics'):
+            cls._rollback_atomics(cls.cls_atomics)
+            del cls.cls_atomics
         cls._tearDownClassInternal()
+        if hasattr(cls, '_stats_totals'):
+            record_class_stats('%s.%s' % (cls.__module__, cls.__name__), cls._stats_totals)
@@ -5,43 +5,208 @@
 """Utilities to delegate execution of a set of functions to a single background thread."""
 
 
+import bisect
+import collections
 import contextlib
+import functools
+import heapq
+import itertools
 import logging
-from .compat import queue
+import sys
+import traceback
+from .compat import asyncio, cpu_count, futures, get_ident, main_thread, queue, timer
 import threading
+import time
 
 logger = logging.getLogger(__name__)
 
 
+class Waiter(object):
+    """A reusable completion signal, for a single waiting thread.
+
+    Built on a bare lock instead of a threading.Event, which would allocate
+    a Condition and a Lock for every call.
+    """
+    __slots__ = ('_lock',)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lock.acquire()
+
+    def set(self):
+        self._lock.release()
+
+    def wait(self, spin=0.0):
+        """Block until set() is called, and rearm the waiter.
+
+        With ``spin``, first poll for up to that many seconds, yielding the
+        GIL in between: this avoids sleeping on the lock for short calls.
+        """
+        if spin:
+            deadline = timer() + spin
+            while not self._lock.acquire(False):
+                if timer() >= deadline:
+                    break
+                time.sleep(0)
+            else:
+                return
+        self._lock.acquire()
+
+
+class Histogram(object):
+    """A histogram of durations, with power-of-ten buckets from 10us to 1s."""
+    BOUNDS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+    LABELS = ('<10us', '<100us', '<1ms', '<10ms', '<100ms', '<1s', '>=1s')
+
+    def __init__(self):
+        self.counts = [0] * len(self.LABELS)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.counts[bisect.bisect_right(self.BOUNDS, duration)] += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    @property
+    def mean(self):
+        count = self.count
+        return self.total / count if count else 0.0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean,
+            'max': self.max,
+            'buckets': list(zip(self.LABELS, self.counts)),
+        }
+
+    def __repr__(self):
+        return '<Histogram: %s>' % ' '.join('%s=%d' % bucket for bucket in zip(self.LABELS, self.counts))
+
+
+class DelegateStats(object):
+    """Collects timings about the tasks run through a delegate.
+
+    Attributes:
+        tasks (int): number of delegated tasks
+        wait (Histogram): time spent by tasks before starting to run
+        run (Histogram): time spent running tasks
+        max_depth (int): maximum number of tasks waiting at once
+        threads (Counter): number of tasks per calling thread name
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.tasks = 0
+            self.wait = Histogram()
+            self.run = Histogram()
+            self.max_depth = 0
+            self.threads = collections.Counter()
+
+    def record(self, caller, wait, duration, depth):
+        with self._lock:
+            self.tasks += 1
+            self.wait.add(wait)
+            self.run.add(duration)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            self.threads[caller] += 1
+
+    def totals(self):
+        """Return (tasks, total wait, total run) - for computing deltas."""
+        with self._lock:
+            return (self.tasks, self.wait.total, self.run.total)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'tasks': self.tasks,
+                'wait': self.wait.as_dict(),
+                'run': self.run.as_dict(),
+                'max_depth': self.max_depth,
+                'threads': dict(self.threads),
+            }
+
+    def summary(self):
+        """A human-readable summary, as a list of lines."""
+        with self._lock:
+            lines = [
+                "tasks: %d, max depth: %d" % (self.tasks, self.max_depth),
+            ]
+            for label, histogram in (('wait', self.wait), ('run', self.run)):
+                lines.append("%s: total=%.3fs mean=%.1fus max=%.1fus" % (
+                    label, histogram.total, histogram.mean * 1e6, histogram.max * 1e6))
+                lines.append("    %s" % ' '.join(
+                    '%s:%d' % bucket for bucket in zip(histogram.LABELS, histogram.counts)))
+            for name, count in self.threads.most_common():
+                lines.append("thread %s: %d tasks" % (name, count))
+        return lines
+
+
 class Task(object):
     """A simple object representing a task to run."""
     KIND_STOP = 'STOP'
     KIND_DATA = 'DATA'
 
-    def __init__(self, kind=KIND_DATA, function=None, args=None, kwargs=None):
+    __slots__ = (
+        'kind', 'function', 'args', 'kwargs', 'done', 'finished', 'result', 'exception',
+        # The thread which created the task
+        'origin',
+        # Timestamps, only filled when collecting stats
+        'started_at', 'finished_at',
+    )
+
+    def __init__(self, kind=KIND_DATA, function=None, args=(), kwargs=None, done=None):
         self.kind = kind
         self.function = function
-        self.args = args or ()
-        self.kwargs = kwargs or {}
-        self.done = threading.Event()
+        self.args = args
+        self.kwargs = {} if kwargs is None else kwargs
+        self.done = done
+        self.finished = False
         self.result = None
         self.exception = None
+        self.origin = threading.current_thread()
 
     def execute(self):
         """Execute the task.
 
         This *will* catch exceptions raised within the task, and won't re-raise them.
         """
+        self._call()
+        self._complete()
+
+    def execute_timed(self):
+        """Execute the task, recording its start and end timestamps."""
+        self.started_at = timer()
+        self._call()
+        self.finished_at = timer()
+        self._complete()
+
+    def _call(self):
         try:
             self.result = self.function(*self.args, **self.kwargs)
         except Exception as e:
             self.exception = e
-        self.done.set()
+
+    def _complete(self):
+        self.finished = True
+        if self.done is not None:
+            self.done.set()
 
     def __repr__(self):
         if self.kind == self.KIND_STOP:
             return '<Task: STOP>'
-        if not self.done.is_set():
+        if not self.finished:
             return "<Task: %s(*%r, **%r) (pending)>" % (
                 self.function, self.args, self.kwargs)
         if self.exception is None:
@@ -52,9 +217,323 @@ class Task(object):
                 self.function, self.args, self.kwargs, self.exception)
 
 
+class AsyncTask(Task):
+    """A task nobody waits for; records its own stats, if enabled."""
+    __slots__ = ('stats', 'caller', 'queued_at', 'depth')
+
+    def __init__(self, function, args, kwargs, stats=None):
+        super(AsyncTask, self).__init__(function=function, args=args, kwargs=kwargs)
+        self.stats = stats
+        if stats is not None:
+            self.caller = threading.current_thread().name
+            self.queued_at = timer()
+
+    def _record(self):
+        if self.stats is not None:
+            self.stats.record(
+                self.caller,
+                wait=self.started_at - self.queued_at,
+                duration=self.finished_at - self.started_at,
+                depth=self.depth,
+            )
+
+
+class FutureTask(AsyncTask):
+    """A task resolving a concurrent.futures.Future on completion."""
+    __slots__ = ('future',)
+
+    def __init__(self, future, function, args, kwargs, stats=None):
+        super(FutureTask, self).__init__(function, args, kwargs, stats=stats)
+        self.future = future
+
+    def _call(self):
+        # Skip tasks cancelled while queued.
+        if self.future.set_running_or_notify_cancel():
+            super(FutureTask, self)._call()
+
+    def _complete(self):
+        self.finished = True
+        if self.future.cancelled():
+            return
+        self._record()
+        if self.exception is not None:
+            self.future.set_exception(self.exception)
+        else:
+            self.future.set_result(self.result)
+
+
+class SharedTask(Task):
+    """A task whose outcome is shared with identical calls queued right after it.
+
+    Callers join it through the ``flights`` dict of their DelegateQueue, until
+    it starts running; all their waiters are then set on completion.
+    """
+    __slots__ = ('key', 'flights', 'lock', 'waiters', 'joinable')
+
+    def __init__(self, key, flights, lock, function, args, kwargs, done):
+        super(SharedTask, self).__init__(function=function, args=args, kwargs=kwargs, done=done)
+        self.key = key
+        self.flights = flights
+        self.lock = lock
+        self.waiters = []
+        self.joinable = True
+
+    def _call(self):
+        with self.lock:
+            self.joinable = False
+            if self.flights.get(self.key) is self:
+                del self.flights[self.key]
+        super(SharedTask, self)._call()
+
+    def _complete(self):
+        self.finished = True
+        self.done.set()
+        for waiter in self.waiters:
+            waiter.set()
+
+
+class DelegateTimeout(Exception):
+    """Raised when a delegated call exceeds its timeout; the message describes all involved threads."""
+
+
+class TimedTask(Task):
+    """A task whose caller may give up on it; see DelegateQueue's ``timeout``.
+
+    Once abandoned, the task won't run if it hasn't started yet, and won't
+    signal completion to its caller - who got a DelegateTimeout instead.
+    """
+    __slots__ = ('deadline', 'caller', 'caller_ident', 'abandoned', 'lock')
+
+    def __init__(self, deadline, lock, function, args, kwargs, done):
+        super(TimedTask, self).__init__(function=function, args=args, kwargs=kwargs, done=done)
+        self.deadline = deadline
+        self.lock = lock
+        self.caller = threading.current_thread().name
+        self.caller_ident = get_ident()
+        self.abandoned = False
+
+    def _call(self):
+        if not self.abandoned:
+            super(TimedTask, self)._call()
+
+    def _complete(self):
+        with self.lock:
+            if self.abandoned:
+                return
+            self.finished = True
+            self.done.set()
+
+    def abandon(self, exception):
+        """Fail the task for its caller, unless already done; return whether it was abandoned."""
+        with self.lock:
+            if self.finished or self.abandoned:
+                return False
+            self.abandoned = True
+            self.exception = exception
+            self.done.set()
+            return True
+
+
+class Watchdog(threading.Thread):
+    """Periodically fails the calls of a DelegateQueue running past their deadline."""
+
+    def __init__(self, queue, interval, name=None):
+        super(Watchdog, self).__init__(name=name)
+        self.daemon = True
+        self.queue = queue
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.queue._check_deadlines()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def format_thread_stack(ident):
+    """The current stack of a thread, as a string."""
+    frame = sys._current_frames().get(ident)
+    if frame is None:
+        return '    (not running)\n'
+    return ''.join('    ' + line for line in ''.join(traceback.format_stack(frame)).splitlines(True))
+
+
+class DeferredTask(AsyncTask):
+    """A fire-and-forget task, keeping its exception in its caller's ``errors`` list.
+
+    Skipped if an earlier deferred call from the same caller failed.
+    """
+    __slots__ = ('errors',)
+
+    def __init__(self, errors, function, args, kwargs, stats=None):
+        super(DeferredTask, self).__init__(function, args, kwargs, stats=stats)
+        self.errors = errors
+
+    def _call(self):
+        if not self.errors:
+            super(DeferredTask, self)._call()
+
+    def _complete(self):
+        self.finished = True
+        self._record()
+        if self.exception is not None:
+            logger.debug("Deferred %r failed", self)
+            self.errors.append(self.exception)
+
+
+def _raise_deferred(errors, function, *args, **kwargs):
+    """Run a call, unless an earlier deferred call from the same thread failed."""
+    if errors:
+        error = errors[0]
+        del errors[:]
+        raise error
+    return function(*args, **kwargs)
+
+
+def run_batch(calls, stop_on_error=True):
+    """Run a list of (function, args, kwargs) calls in order, returning their results.
+
+    With ``stop_on_error``, the first failure is raised right away and later
+    calls don't run; otherwise, all calls run, then the first failure is raised.
+    """
+    results = []
+    error = None
+    for function, args, kwargs in calls:
+        try:
+            results.append(function(*args, **kwargs))
+        except Exception as e:
+            if stop_on_error:
+                raise
+            if error is None:
+                error = e
+            results.append(None)
+    if error is not None:
+        raise error
+    return results
+
+
 STOP_TASK = Task(kind=Task.KIND_STOP)
 
 
+def _make_future():
+    if futures is None:
+        raise RuntimeError("submit() requires the 'futures' package on Python 2.")
+    return futures.Future()
+
+
+def _completed_future(function, args, kwargs):
+    """Run a call synchronously, returning a Future holding its outcome."""
+    future = _make_future()
+    future.set_running_or_notify_cancel()
+    try:
+        result = function(*args, **kwargs)
+    except Exception as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+    return future
+
+
+def _wrap_future(future):
+    """Make a concurrent.futures.Future awaitable from the current event loop."""
+    if asyncio is None:
+        raise RuntimeError("execute_async() requires asyncio (Python 3.4+).")
+    return asyncio.wrap_future(future)
+
+
+# Provide map(), shutdown() and context manager support when available.
+ExecutorBase = futures.Executor if futures is not None else object
+
+
+# Scheduling policies
+# ===================
+#
+# Queue.Queue subclasses, overriding the storage hooks like the stdlib's
+# PriorityQueue. _put() runs on the calling thread.
+# Calls from a given thread are always run in order; the STOP task is only
+# served once all others are done.
+
+
+class ThreadPriorityQueue(queue.Queue):
+    """Serves calls by priority of their calling thread, then in order.
+
+    ``priorities`` maps thread idents to priorities (lower first); the main
+    thread - usually running the tests - defaults to 0, other threads to 1.
+    """
+    DEFAULT_PRIORITY = 1
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.counter = itertools.count()
+        self.stop_task = None
+        self.priorities = {main_thread().ident: 0}
+
+    def _qsize(self, len=len):
+        return len(self.queue) + (self.stop_task is not None)
+
+    def _put(self, task):
+        if task.kind == task.KIND_STOP:
+            self.stop_task = task
+            return
+        priority = self.priorities.get(get_ident(), self.DEFAULT_PRIORITY)
+        heapq.heappush(self.queue, (priority, next(self.counter), task))
+
+    def _get(self):
+        if self.queue:
+            return heapq.heappop(self.queue)[2]
+        task, self.stop_task = self.stop_task, None
+        return task
+
+
+class RoundRobinQueue(queue.Queue):
+    """Serves calling threads in turn, each in order."""
+
+    def _init(self, maxsize):
+        # Thread ident => pending tasks, the next thread to serve first.
+        self.queue = collections.OrderedDict()
+        self.size = 0
+        self.stop_task = None
+
+    def _qsize(self):
+        return self.size + (self.stop_task is not None)
+
+    def _put(self, task):
+        if task.kind == task.KIND_STOP:
+            self.stop_task = task
+            return
+        ident = get_ident()
+        try:
+            self.queue[ident].append(task)
+        except KeyError:
+            self.queue[ident] = collections.deque([task])
+        self.size += 1
+
+    def _get(self):
+        if not self.size:
+            task, self.stop_task = self.stop_task, None
+            return task
+        ident, tasks = self.queue.popitem(last=False)
+        task = tasks.popleft()
+        if tasks:
+            # Back to the end of the line
+            self.queue[ident] = tasks
+        self.size -= 1
+        return task
+
+
+SCHEDULING_FIFO = 'fifo'
+SCHEDULING_PRIORITY = 'priority'
+SCHEDULING_ROUND_ROBIN = 'round-robin'
+SCHEDULERS = {
+    SCHEDULING_FIFO: queue.Queue,
+    SCHEDULING_PRIORITY: ThreadPriorityQueue,
+    SCHEDULING_ROUND_ROBIN: RoundRobinQueue,
+}
+
+
 class DelegateThread(threading.Thread):
     """Support for the background work."""
     def __init__(self, queue, name=None):
@@ -62,14 +541,25 @@ class DelegateThread(threading.Thread):
         super(DelegateThread, self).__init__(name=name)
 
     def run(self):
+        # Set here: the first task may run before start() returns.
+        self.queue.inner_ident = get_ident()
         while True:
-            with self.queue.consume() as task:
-                if task.kind == task.KIND_STOP:
+            try:
+                with self.queue.consume(timeout=self.queue.idle_timeout) as task:
+                    if task.kind == task.KIND_STOP:
+                        break
+                    self.queue.current_task = task
+                    if self.queue.stats is None:
+                        task.execute()
+                    else:
+                        task.execute_timed()
+                    self.queue.current_task = None
+            except queue.Empty:
+                if self.queue._exit_idle():
                     break
-                task.execute()
 
 
-class DelegateQueue(object):
+class DelegateQueue(ExecutorBase):
     """Delegates calls to a background thread.
 
     Can be used to enforce serialized accesses, or to wrap calls to a
@@ -85,59 +575,421 @@ class DelegateQueue(object):
 
     Notes:
         * If a ``name`` is provided, it is used for the underlying thread (helps with logging)
+        * The thread is only spawned by the first call; with an ``idle_timeout`` (in seconds),
+          it exits after that long without calls, and gets spawned again on the next one
         * When the DelegateQueue is garbage-collected, it will attempt to stop the background thread
         * There is a single, synchronous entry point for code execution: ``execute(callable, *args, **kwargs)
+        * With ``stats=True``, timings are collected in a DelegateStats, available as ``queue.stats``
+        * It is also a ``concurrent.futures.Executor``: ``submit()`` queues a call without
+          waiting for it (requires the ``futures`` package on Python 2)
+        * ``execute_nowait()`` queues a call whose result isn't needed; if it fails, the
+          error is raised by the next ``execute()`` from the same thread, instead of running it
+        * ``scheduling`` selects the order of calls from different threads: ``'fifo'``
+          (default), ``'priority'`` (main thread first) or ``'round-robin'`` (each thread in turn)
+        * ``execute_batch(calls)`` runs a list of ``(callable, args, kwargs)`` in a single hop
+        * ``execute_async()`` returns an asyncio future: coroutines can await delegated
+          calls without blocking their event loop
+        * ``execute_shared(key, callable, ...)`` shares the outcome of an identical call
+          (same ``key``) still queued, if no other call was queued since then; only
+          with ``'fifo'`` scheduling
+        * With a ``timeout`` (in seconds), a Watchdog thread fails ``execute()`` calls not
+          done within that time with a DelegateTimeout, describing what the background
+          thread and all waiting callers were doing; calls abandoned that way don't run
+        * With ``spin`` (in seconds), the background thread polls for that long for a new
+          call before sleeping, and callers poll for up to that long for their result -
+          as long as recent calls completed within that time; see ``spin_budget()``.
+          Ignored on single-CPU hosts, where polling only delays the thread it waits for.
     """
 
-    def __init__(self, name=None):
-        self.inner_queue = queue.Queue()
+    # Callers poll for up to SPIN_FACTOR times the recent round-trip latency.
+    SPIN_FACTOR = 2
+    # Weight of the latest round trip in the moving average of latencies.
+    LATENCY_WEIGHT = 0.125
+
+    def __init__(self, name=None, stats=False, scheduling=SCHEDULING_FIFO, idle_timeout=None, spin=0.0,
+            timeout=None):
         self.started = False
+        # Whether the background thread is alive; guarded by _thread_lock.
+        self.running = False
+        if scheduling not in SCHEDULERS:
+            raise ValueError("Unknown scheduling policy %r" % scheduling)
+        self.scheduling = scheduling
+        self.inner_queue = SCHEDULERS[scheduling]()
+        self.stats = DelegateStats() if stats else None
+        self.idle_timeout = idle_timeout
+        self.spin = spin if cpu_count() > 1 else 0.0
+        # Moving average of execute() round trips, only tracked with spin.
+        self.latency = 0.0
         self.inner_thread = None
+        self.inner_ident = None
         self.name = name
+        self._thread_lock = threading.Lock()
+        # With a timeout: calls waited for, and the task running on the background thread.
+        self.timeout = timeout
+        self.watchdog = None
+        self.current_task = None
+        self._timed_tasks = set()
+        self._timed_lock = threading.Lock()
+        # SharedTasks other calls may join, by key; see execute_shared().
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        # One reusable Waiter per calling thread, along with its deferred calls' errors
+        self._waiters = threading.local()
 
     # Thread management
     # =================
 
     def start(self):
+        """Accept calls; the background thread is spawned on the first one."""
         assert not self.started
-        self.inner_thread = DelegateThread(queue=self, name=self.name)
-        self.inner_thread.daemon = True
-        self.inner_thread.start()
         self.started = True
-        logger.debug("Started delegate thread %s(%s) from %s(%s)",
-            self.inner_thread.ident, self.inner_thread.name,
-            threading.current_thread().ident, threading.current_thread().name,
-        )
 
     def stop(self):
         assert self.started
-        self.inner_queue.put(STOP_TASK)
+        with self._thread_lock:
+            if self.running:
+                self.inner_queue.put(STOP_TASK)
         self.inner_queue.join()
+        with self._thread_lock:
+            self.running = False
+            self.inner_thread = None
+            self.inner_ident = None
+            watchdog, self.watchdog = self.watchdog, None
+        if watchdog is not None:
+            watchdog.stop()
+        self.started = False
 
     def __del__(self):
-        self.stop()
+        if self.started:
+            self.stop()
+
+    def abandon(self):
+        """Forget the background thread without stopping it.
+
+        For use in a forked child, where that thread doesn't exist: the
+        delegate can't be used anymore.
+        """
+        self.started = False
+        self.running = False
+        self.inner_thread = None
+        self.inner_ident = None
+        self.watchdog = None
+
+    def _ensure_running(self):
+        """Spawn the background thread, unless already running.
+
+        Callers queue their task first, then check ``running``: either the
+        thread sees the task before exiting on idle, or the caller sees that
+        it exited.
+        """
+        with self._thread_lock:
+            if self.running:
+                return
+            thread = DelegateThread(queue=self, name=self.name)
+            thread.daemon = True
+            self.inner_thread = thread
+            thread.start()
+            self.running = True
+            if self.timeout and self.watchdog is None:
+                self.watchdog = Watchdog(self, interval=min(self.timeout / 4.0, 1.0),
+                    name='%s-watchdog' % (self.name or 'delegate'))
+                self.watchdog.start()
+        logger.debug("Started delegate thread %s(%s) from %s(%s)",
+            thread.ident, thread.name,
+            threading.current_thread().ident, threading.current_thread().name,
+        )
+
+    def _wake(self):
+        """Make sure a task just queued will be consumed."""
+        if not self.running:
+            self._ensure_running()
+
+    def _exit_idle(self):
+        """Called by the background thread after idle_timeout without tasks.
+
+        Returns whether the thread should exit.
+        """
+        with self._thread_lock:
+            # Clear the flag before looking at the queue: a caller which still
+            # sees ``running`` queued its task before, and we'll find it.
+            self.running = False
+            if self.inner_queue.qsize():
+                # A task came in meanwhile.
+                self.running = True
+                return False
+            self.inner_thread = None
+            self.inner_ident = None
+        logger.debug("Delegate thread %s idle for %ss, exiting", self.name, self.idle_timeout)
+        return True
+
+    def in_thread(self):
+        """Whether the current thread is the background thread."""
+        return get_ident() == self.inner_ident
+
+    def calling_thread(self):
+        """The thread on whose behalf the current code runs.
+
+        On the background thread, that's the thread which queued the running task.
+        """
+        task = self.current_task
+        if task is not None and self.in_thread():
+            return task.origin
+        return threading.current_thread()
+
+    def spin_budget(self):
+        """How long callers should poll for their result before sleeping.
+
+        Polling only pays off if the result comes in soon: callers don't poll
+        at all once recent round trips take longer than ``spin``.
+        """
+        latency = self.latency
+        if latency > self.spin:
+            return 0.0
+        return min(self.spin, latency * self.SPIN_FACTOR)
+
+    def _record_latency(self, latency):
+        # Unlocked: a lost update between callers is harmless.
+        self.latency += (latency - self.latency) * self.LATENCY_WEIGHT
 
     # Incoming tasks
     # ==============
 
+    def _put(self, task):
+        self.inner_queue.put(task)
+        if self._flights:
+            # Calls queued from now on must not run before this one.
+            with self._flights_lock:
+                self._flights.clear()
+
     def execute(self, function, *args, **kwargs):
         assert self.started
 
-        if threading.current_thread().ident == self.inner_thread.ident:
+        if get_ident() == self.inner_ident:
             # Don't delegate tasks generated from within another task,
             # as that would lock.
             return function(*args, **kwargs)
 
         # We're calling from outside the worker thread, let's run properly.
-        task = Task(function=function, args=args, kwargs=kwargs)
-        self.inner_queue.put(task)
+        local = self._waiters
+        try:
+            waiter = local.waiter
+        except AttributeError:
+            waiter = local.waiter = Waiter()
+        if getattr(local, 'deferred', False):
+            # Tasks are run in order: all deferred calls will be done by then.
+            local.deferred = False
+            args = (local.errors, function) + args
+            function = _raise_deferred
+        if self.timeout:
+            return self._execute_timed_task(waiter, function, args, kwargs)
+        task = Task(function=function, args=args, kwargs=kwargs, done=waiter)
+        stats = self.stats
+        spin = self.spin
+        if stats is not None:
+            depth = self.inner_queue.qsize() + 1
+        if stats is not None or spin:
+            queued_at = timer()
+        self._put(task)
+        self._wake()
 
         # Wait for completion
-        task.done.wait()
+        try:
+            waiter.wait(self.spin_budget() if spin else 0.0)
+        except BaseException:
+            # Interrupted: the worker will still set() this waiter later on,
+            # so it can't be reused.
+            del self._waiters.waiter
+            raise
+        if spin:
+            self._record_latency(timer() - queued_at)
+        if stats is not None:
+            stats.record(
+                threading.current_thread().name,
+                wait=task.started_at - queued_at,
+                duration=task.finished_at - task.started_at,
+                depth=depth,
+            )
         if task.exception is not None:
             raise task.exception
         return task.result
 
+    def _execute_timed_task(self, waiter, function, args, kwargs):
+        """execute(), failing with a DelegateTimeout after ``timeout`` seconds."""
+        task = TimedTask(timer() + self.timeout, self._timed_lock, function, args, kwargs, done=waiter)
+        stats = self.stats
+        if stats is not None:
+            queued_at = timer()
+            depth = self.inner_queue.qsize() + 1
+        with self._timed_lock:
+            self._timed_tasks.add(task)
+        try:
+            self._put(task)
+            self._wake()
+            try:
+                waiter.wait()
+            except BaseException:
+                del self._waiters.waiter
+                raise
+        finally:
+            with self._timed_lock:
+                self._timed_tasks.discard(task)
+        if task.abandoned:
+            raise task.exception
+        if stats is not None:
+            stats.record(
+                threading.current_thread().name,
+                wait=task.started_at - queued_at,
+                duration=task.finished_at - task.started_at,
+                depth=depth,
+            )
+        if task.exception is not None:
+            raise task.exception
+        return task.result
+
+    def _check_deadlines(self):
+        """Abandon the calls past their deadline; called by the Watchdog."""
+        now = timer()
+        with self._timed_lock:
+            expired = [task for task in self._timed_tasks if task.deadline <= now]
+        if not expired:
+            return
+        report = self.describe_threads()
+        logger.error("Delegated calls timed out after %ss:\n%s", self.timeout, report)
+        for task in expired:
+            task.abandon(DelegateTimeout("Call to %r on delegate %s timed out after %ss.\n%s" % (
+                task.function, self.name, self.timeout, report)))
+
+    def describe_threads(self):
+        """Describe the running task, and where the background thread and callers are."""
+        lines = [
+            "In-flight task on %s: %r" % (self.name, self.current_task),
+            "Delegate thread %s:" % self.name,
+            format_thread_stack(self.inner_ident),
+        ]
+        with self._timed_lock:
+            waiting = sorted(self._timed_tasks, key=lambda task: task.deadline)
+        for task in waiting:
+            lines.append("Caller thread %s, waiting for %r:" % (task.caller, task))
+            lines.append(format_thread_stack(task.caller_ident))
+        return '\n'.join(lines)
+
+    def execute_batch(self, calls, stop_on_error=True):
+        """Run a list of (function, args, kwargs) calls in a single task; see run_batch()."""
+        return self.execute(run_batch, calls, stop_on_error)
+
+    def execute_shared(self, key, function, *args, **kwargs):
+        """Like execute(), sharing the outcome of an identical call already queued.
+
+        The call is only run once for all callers using the same ``key``
+        while it's waiting in the queue - unless another call got queued
+        after it: the shared call never runs before calls queued earlier
+        by any of its callers.
+        The shared result isn't copied: it should be immutable.
+        Calls are only shared with FIFO scheduling: other policies would run
+        the shared call in its first caller's turn, possibly ahead of calls
+        queued earlier by the others.
+        """
+        assert self.started
+
+        if get_ident() == self.inner_ident:
+            return function(*args, **kwargs)
+        local = self._waiters
+        if self.timeout or self.scheduling != SCHEDULING_FIFO or getattr(local, 'deferred', False):
+            return self.execute(function, *args, **kwargs)
+
+        try:
+            waiter = local.waiter
+        except AttributeError:
+            waiter = local.waiter = Waiter()
+        stats = self.stats
+        with self._flights_lock:
+            task = self._flights.get(key)
+            if task is not None and task.joinable:
+                task.waiters.append(waiter)
+                leader = False
+            else:
+                task = SharedTask(key, self._flights, self._flights_lock, function, args, kwargs, done=waiter)
+                if stats is not None:
+                    queued_at = timer()
+                    depth = self.inner_queue.qsize() + 1
+                # Registered first: calls queued after it see it in _put().
+                self._flights[key] = task
+                self.inner_queue.put(task)
+                leader = True
+        self._wake()
+
+        try:
+            waiter.wait()
+        except BaseException:
+            del self._waiters.waiter
+            raise
+        if leader and stats is not None:
+            stats.record(
+                threading.current_thread().name,
+                wait=task.started_at - queued_at,
+                duration=task.finished_at - task.started_at,
+                depth=depth,
+            )
+        if task.exception is not None:
+            raise task.exception
+        return task.result
+
+    def submit(self, function, *args, **kwargs):
+        """Queue a call, returning a concurrent.futures.Future for its outcome."""
+        assert self.started
+
+        if get_ident() == self.inner_ident:
+            # Waiting on the future from within a task would lock.
+            return _completed_future(function, args, kwargs)
+
+        task = FutureTask(_make_future(), function, args, kwargs, stats=self.stats)
+        if self.stats is not None:
+            task.depth = self.inner_queue.qsize() + 1
+        self._put(task)
+        self._wake()
+        return task.future
+
+    def execute_async(self, function, *args, **kwargs):
+        """Queue a call, returning an asyncio future for its outcome.
+
+        Must be called from a thread with an event loop.
+        """
+        return _wrap_future(self.submit(function, *args, **kwargs))
+
+    def execute_nowait(self, function, *args, **kwargs):
+        """Queue a call without waiting for it.
+
+        If the call fails, its exception is raised by the next call to
+        ``execute()`` from the same thread, which is then skipped - as are
+        the calls deferred in between.
+        """
+        assert self.started
+
+        if get_ident() == self.inner_ident:
+            function(*args, **kwargs)
+            return
+
+        local = self._waiters
+        try:
+            errors = local.errors
+        except AttributeError:
+            errors = local.errors = []
+        local.deferred = True
+        task = DeferredTask(errors, function, args, kwargs, stats=self.stats)
+        if self.stats is not None:
+            task.depth = self.inner_queue.qsize() + 1
+        self._put(task)
+        self._wake()
+
+    def has_deferred(self):
+        """Whether the current thread deferred calls, not yet checked by a synchronous call."""
+        return getattr(self._waiters, 'deferred', False)
+
+    def shutdown(self, wait=True):
+        """Executor API: stop the background thread, once pending tasks are done."""
+        if self.started:
+            self.stop()
+
     # Thread-side functions
     # =====================
 
@@ -145,6 +997,19 @@ class DelegateQueue(object):
         """Ensure that the code is executing within the background thread."""
         assert threading.current_thread().ident == self.inner_thread.ident
 
+    def _get_task(self, block, timeout):
+        """Fetch the next task, polling for up to ``spin`` seconds before sleeping."""
+        if block and self.spin:
+            deadline = timer() + self.spin
+            while True:
+                try:
+                    return self.inner_queue.get(block=False)
+                except queue.Empty:
+                    if timer() >= deadline:
+                        break
+                    time.sleep(0)
+        return self.inner_queue.get(block=block, timeout=timeout)
+
     @contextlib.contextmanager
     def consume(self, block=True, timeout=None):
         """Handle an incoming task.
@@ -152,10 +1017,144 @@ class DelegateQueue(object):
         This code *must* be executed within the background thread."""
         self._assert_in_thread()
 
-        item = self.inner_queue.get(block=block, timeout=timeout)
+        item = self._get_task(block, timeout)
         try:
             yield item
         finally:
             self.inner_queue.task_done()
 
 
+class DelegateLock(object):
+    """Serializes calls with a lock, running them on the calling thread.
+
+    A drop-in alternative to DelegateQueue, avoiding the thread hop; only
+    suitable for libraries that tolerate being called from several threads,
+    as long as calls don't overlap.
+
+    Usage:
+
+        >>> lock = threlegate.DelegateLock(name='db')
+        >>> lock.start()
+        >>> lock.execute(os.path.join, '/', 'foo')
+        '/foo'
+        >>> lock.stop()
+
+    Notes:
+        * The lock is reentrant: a call may perform nested ``execute()`` calls
+        * ``owner`` holds the ident of the thread currently running a call, if any
+        * ``execute_async()`` waits for the lock on the event loop's default executor
+        * With ``stats=True``, timings are collected in a DelegateStats, available as ``lock.stats``;
+          the "wait" is the time spent acquiring the lock.
+    """
+
+    def __init__(self, name=None, stats=False):
+        self.lock = threading.RLock()
+        self.stats = DelegateStats() if stats else None
+        self.waiting = 0
+        self._waiting_lock = threading.Lock()
+        self.started = False
+        self.owner = None
+        self.depth = 0
+        self.name = name
+
+    # Lifecycle
+    # =========
+
+    def start(self):
+        assert not self.started
+        self.started = True
+
+    def stop(self):
+        assert self.started
+        self.started = False
+
+    # Incoming tasks
+    # ==============
+
+    def is_owned(self):
+        """Whether the current thread holds the lock."""
+        return self.owner == get_ident()
+
+    def execute(self, function, *args, **kwargs):
+        assert self.started
+
+        if self.stats is not None and not self.is_owned():
+            return self._execute_timed(function, args, kwargs)
+
+        with self.lock:
+            return self._run(function, args, kwargs)
+
+    def in_thread(self):
+        """Whether the current thread is running a call."""
+        return self.is_owned()
+
+    def calling_thread(self):
+        """Calls run on their caller's thread: that's the current one."""
+        return threading.current_thread()
+
+    def abandon(self):
+        """Stop accepting calls; in a forked child, the lock may be held by a vanished thread."""
+        self.started = False
+
+    def execute_batch(self, calls, stop_on_error=True):
+        """Run a list of (function, args, kwargs) calls under a single lock acquisition."""
+        return self.execute(run_batch, calls, stop_on_error)
+
+    def execute_shared(self, key, function, *args, **kwargs):
+        """Calls don't wait in a queue: nothing to share, just run it."""
+        return self.execute(function, *args, **kwargs)
+
+    def submit(self, function, *args, **kwargs):
+        """Run a call right away, returning a completed concurrent.futures.Future."""
+        return _completed_future(self.execute, (function,) + args, kwargs)
+
+    def execute_async(self, function, *args, **kwargs):
+        """Run a call from the event loop's default executor, returning an asyncio future.
+
+        The event loop doesn't block while waiting for the lock, unless it already holds it.
+        """
+        if asyncio is None or self.is_owned():
+            return _wrap_future(self.submit(function, *args, **kwargs))
+        return asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(self.execute, function, *args, **kwargs))
+
+    def execute_nowait(self, function, *args, **kwargs):
+        """Calls already run on the caller's thread: just run it."""
+        self.execute(function, *args, **kwargs)
+
+    def has_deferred(self):
+        """Calls are never deferred."""
+        return False
+
+    def _execute_timed(self, function, args, kwargs):
+        queued_at = timer()
+        with self._waiting_lock:
+            self.waiting += 1
+            depth = self.waiting
+        try:
+            self.lock.acquire()
+        finally:
+            with self._waiting_lock:
+                self.waiting -= 1
+        started_at = timer()
+        try:
+            return self._run(function, args, kwargs)
+        finally:
+            self.lock.release()
+            self.stats.record(
+                threading.current_thread().name,
+                wait=started_at - queued_at,
+                duration=timer() - started_at,
+                depth=depth,
+            )
+
+    def _run(self, function, args, kwargs):
+        """Run a call; the lock *must* be held."""
+        self.owner = get_ident()
+        self.depth += 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.depth -= 1
+            if not self.depth:
+                self.owner = None
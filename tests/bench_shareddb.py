@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Raphaël Barrois
+# This software is distributed under the two-clause BSD license.
+
+"""Benchmark suite for shareddb, run against the dev project's databases.
+
+Usage:
+
+    $ python -m tests.bench_shareddb [--output bench.json] [--tests 20] [--rows 50]
+
+Covers:
+- delegate: DelegateQueue round trips against direct calls (see tests.bench_threlegate)
+- queries: per-query overhead of the delegating wrapper, for each shareddb alias
+- live_server: shareddb's LiveServerTestCase against Django's (which flushes the
+  database after each test), running N tests each creating and reading M rows
+- concurrency: live server throughput and delegate wait, with concurrent request threads
+
+Results are also written as JSON to ``--output``, for comparisons between releases.
+To benchmark PostgreSQL, add a shareddb alias using it to ``dev/settings.py``
+and pass ``--database <alias>``.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import sys
+import threading
+import unittest
+
+import requests
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dev.settings')
+
+import django
+from django.db import connections, transaction, utils
+from django.test import runner
+from django.test import testcases
+
+from shareddb import testcase
+from shareddb.backends.shareddb import base
+from shareddb.compat import timer
+
+from . import bench_threlegate
+
+
+# Per-query overhead
+# ==================
+
+def bench_queries(alias, queries):
+    """Time single-row lookups, on a direct connection and on a shareddb one."""
+    settings_dict = connections[alias].settings_dict
+    inner_backend = utils.load_backend(settings_dict['INNER_ENGINE'])
+    wrappers = [
+        ('direct', inner_backend.DatabaseWrapper(dict(settings_dict), 'bench-direct')),
+        ('shareddb', base.make_wrapper(dict(settings_dict), 'bench-shareddb')),
+    ]
+
+    results = {'vendor': wrappers[0][1].vendor, 'queries': queries}
+    try:
+        for label, wrapper in wrappers:
+            cursor = wrapper.cursor()
+            cursor.execute("CREATE TEMPORARY TABLE bench_query (id INTEGER, data VARCHAR(32))")
+            cursor.executemany("INSERT INTO bench_query VALUES (%s, %s)",
+                [(i, 'row %d' % i) for i in range(100)])
+            start = timer()
+            for i in range(queries):
+                cursor.execute("SELECT data FROM bench_query WHERE id = %s", [i % 100])
+                cursor.fetchone()
+            results['%s_us' % label] = (timer() - start) / queries * 1e6
+            cursor.execute("DROP TABLE bench_query")
+            wrapper.close()
+    finally:
+        base.DELEGATES.pop('bench-shareddb').stop()
+    results['overhead_us'] = results['shareddb_us'] - results['direct_us']
+    return results
+
+
+# Test cases
+# ==========
+
+def make_test_case(base_class, tests, rows):
+    """Build a test case with ``tests`` tests, each creating ``rows`` rows and reading them."""
+    from .testapp import models
+
+    def setUp(self):
+        models.Something.objects.bulk_create(
+            models.Something(data='row %d' % i) for i in range(rows))
+
+    def test(self):
+        response = requests.get(self.live_server_url + '/read/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(rows, len(response.json()))
+
+    attrs = {'__module__': __name__, 'setUp': setUp}
+    for i in range(tests):
+        attrs['test_%03d' % i] = test
+    return type(str('Bench%s' % base_class.__module__.split('.')[0].title()), (base_class,), attrs)
+
+
+def bench_live_server(tests, rows):
+    results = {'tests': tests, 'rows': rows}
+    for label, base_class in (
+            ('django', testcases.LiveServerTestCase),
+            ('shareddb', testcase.LiveServerTestCase)):
+        suite = unittest.TestLoader().loadTestsFromTestCase(make_test_case(base_class, tests, rows))
+        start = timer()
+        result = unittest.TextTestRunner(stream=io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO(),
+            verbosity=0).run(suite)
+        elapsed = timer() - start
+        if not result.wasSuccessful():
+            raise RuntimeError("Benchmark tests for %s failed: %r" % (label, result.errors + result.failures))
+        results[label] = {'total_s': elapsed, 'per_test_ms': elapsed / tests * 1e3}
+    results['speedup'] = results['django']['total_s'] / results['shareddb']['total_s']
+    return results
+
+
+# Concurrency
+# ===========
+
+def bench_concurrency(rows, requests_count, thread_counts):
+    """Live server requests per second, with concurrent clients reading ``rows`` rows."""
+    from .testapp import models
+
+    server = testcase.get_shared_server_thread()
+    url = 'http://%s:%s/read/' % (server.host, server.port)
+    stats = connections['default'].delegate.stats
+    results = []
+
+    atomic = transaction.atomic()
+    atomic.__enter__()
+    try:
+        models.Something.objects.bulk_create(
+            models.Something(data='row %d' % i) for i in range(rows))
+
+        for threads in thread_counts:
+            per_thread = requests_count // threads
+            durations = []
+
+            def client():
+                session = requests.Session()
+                for _i in range(per_thread):
+                    start = timer()
+                    session.get(url).raise_for_status()
+                    durations.append(timer() - start)
+
+            before = stats.totals() if stats is not None else None
+            clients = [threading.Thread(target=client) for _i in range(threads)]
+            start = timer()
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            elapsed = timer() - start
+
+            line = {
+                'threads': threads,
+                'requests': len(durations),
+                'requests_per_s': len(durations) / elapsed,
+                'mean_ms': sum(durations) / len(durations) * 1e3,
+            }
+            if stats is not None:
+                tasks, wait, _run = [after - prev for after, prev in zip(stats.totals(), before)]
+                line['delegate_tasks'] = tasks
+                line['delegate_wait_us'] = wait / tasks * 1e6 if tasks else 0.0
+            results.append(line)
+    finally:
+        connections['default'].needs_rollback = True
+        atomic.__exit__(None, None, None)
+        testcase.stop_shared_server_thread()
+    return results
+
+
+# Reporting
+# =========
+
+def report(results):
+    print("== delegate")
+    bench_threlegate.report(results['delegate'])
+    print("== queries")
+    for alias, line in sorted(results['queries'].items()):
+        print("%s (%s): direct %.2f us/query, shareddb %.2f us/query, overhead %.2f us/query" % (
+            alias, line['vendor'], line['direct_us'], line['shareddb_us'], line['overhead_us']))
+    live = results['live_server']
+    print("== live server (%d tests, %d rows)" % (live['tests'], live['rows']))
+    for label in ('django', 'shareddb'):
+        print("%-8s: %.3fs (%.2f ms/test)" % (label, live[label]['total_s'], live[label]['per_test_ms']))
+    print("speedup: x%.2f" % live['speedup'])
+    print("== concurrency")
+    for line in results['concurrency']:
+        print("%2d threads: %7.1f requests/s, %6.2f ms/request, %6.2f us delegate wait" % (
+            line['threads'], line['requests_per_s'], line['mean_ms'], line.get('delegate_wait_us', 0)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark shareddb")
+    parser.add_argument('--output', default='shareddb-bench.json', help="JSON results file")
+    parser.add_argument('--calls', type=int, default=20000, help="Delegated calls per benchmark")
+    parser.add_argument('--queries', type=int, default=2000, help="Queries per connection")
+    parser.add_argument('--tests', type=int, default=20, help="Tests per test case")
+    parser.add_argument('--rows', type=int, default=50, help="Rows created by each test")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per concurrency level")
+    parser.add_argument('--threads', default='1,2,4,8', help="Concurrency levels")
+    parser.add_argument('--database', action='append', dest='databases',
+        help="Alias to benchmark queries on (default: all shareddb aliases)")
+    args = parser.parse_args(argv[1:])
+    thread_counts = [int(count) for count in args.threads.split(',')]
+
+    if hasattr(django, 'setup'):
+        django.setup()
+    test_runner = runner.DiscoverRunner(verbosity=0)
+    test_runner.setup_test_environment()
+    old_config = test_runner.setup_databases()
+    try:
+        databases = args.databases or [
+            alias for alias in connections
+            if isinstance(connections[alias], base.DelegatingDatabaseWrapper)
+            and base.get_mirror(connections.databases[alias]) is None
+        ]
+        results = {
+            'meta': {
+                'date': datetime.datetime.utcnow().isoformat(),
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+            },
+            'delegate': bench_threlegate.run(args.calls, thread_counts),
+            'queries': dict((alias, bench_queries(alias, args.queries)) for alias in databases),
+            'live_server': bench_live_server(args.tests, args.rows),
+            'concurrency': bench_concurrency(args.rows, args.requests, thread_counts),
+        }
+    finally:
+        test_runner.teardown_databases(old_config)
+        test_runner.teardown_test_environment()
+
+    report(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to %s" % args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
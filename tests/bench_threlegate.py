@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Raphaël Barrois
+# This software is distributed under the two-clause BSD license.
+
+"""Microbenchmark for the per-call overhead of threlegate.DelegateQueue.
+
+Also compares running calls one by one and in batches of ``BATCH_SIZE``,
+and the round-trip latency of trivial SQLite queries for several ``spin`` values.
+
+Usage:
+
+    $ python -m tests.bench_threlegate [calls]
+"""
+
+from __future__ import print_function
+
+import sqlite3
+import sys
+import threading
+import timeit
+
+from shareddb import compat
+from shareddb import threlegate
+
+
+def noop():
+    pass
+
+
+def bench_direct(calls):
+    timer = timeit.Timer(noop)
+    return min(timer.repeat(repeat=3, number=calls)) / calls
+
+
+def bench_execute(calls):
+    delegate = threlegate.DelegateQueue(name='bench')
+    delegate.start()
+    try:
+        timer = timeit.Timer(lambda: delegate.execute(noop))
+        return min(timer.repeat(repeat=3, number=calls)) / calls
+    finally:
+        delegate.stop()
+
+
+BATCH_SIZE = 4
+
+
+def bench_execute_batch(calls):
+    delegate = threlegate.DelegateQueue(name='bench')
+    delegate.start()
+    batch = [(noop, (), {})] * BATCH_SIZE
+    try:
+        timer = timeit.Timer(lambda: delegate.execute_batch(batch))
+        return min(timer.repeat(repeat=3, number=calls // BATCH_SIZE)) / calls
+    finally:
+        delegate.stop()
+
+
+def bench_throughput(calls, threads):
+    """Calls per second, with ``threads`` threads calling concurrently."""
+    delegate = threlegate.DelegateQueue(name='bench')
+    delegate.start()
+
+    def call():
+        for _i in range(calls // threads):
+            delegate.execute(noop)
+
+    workers = [threading.Thread(target=call) for _i in range(threads)]
+    try:
+        start = timeit.default_timer()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return (calls // threads) * threads / (timeit.default_timer() - start)
+    finally:
+        delegate.stop()
+
+
+SPINS = (0.0, 2e-5, 1e-4)
+
+
+def bench_latency(calls, spin):
+    """Round trip of a 'SELECT 1' on an in-memory SQLite database, polling for ``spin`` seconds."""
+    delegate = threlegate.DelegateQueue(name='bench')
+    # Bypass the single-CPU check, to measure it anyway.
+    delegate.spin = spin
+    delegate.start()
+    try:
+        connection = delegate.execute(sqlite3.connect, ':memory:')
+        cursor = delegate.execute(connection.cursor)
+
+        def query():
+            cursor.execute("SELECT 1")
+            return cursor.fetchall()
+
+        timer = timeit.Timer(lambda: delegate.execute(query))
+        latency = min(timer.repeat(repeat=3, number=calls)) / calls
+        delegate.execute(connection.close)
+        return latency
+    finally:
+        delegate.stop()
+
+
+def run(calls, threads=(1, 2, 4, 8)):
+    """Run all benchmarks, returning their results as a dict."""
+    direct = bench_direct(calls)
+    delegated = bench_execute(calls)
+    return {
+        'calls': calls,
+        'direct_us': direct * 1e6,
+        'execute_us': delegated * 1e6,
+        'hop_overhead_us': (delegated - direct) * 1e6,
+        'batched_us': bench_execute_batch(calls) * 1e6,
+        'batch_size': BATCH_SIZE,
+        'throughput': dict((str(count), bench_throughput(calls, count)) for count in threads),
+        'cpus': compat.cpu_count(),
+        'sqlite_latency_us': dict(('%g' % spin, bench_latency(calls, spin) * 1e6) for spin in SPINS),
+    }
+
+
+def report(results):
+    print("direct call:      %8.2f us/call" % results['direct_us'])
+    print("delegated call:   %8.2f us/call" % results['execute_us'])
+    print("per-hop overhead: %8.2f us/call" % results['hop_overhead_us'])
+    print("batched call:     %8.2f us/call (batches of %d)" % (results['batched_us'], results['batch_size']))
+    for threads, rate in sorted(results['throughput'].items(), key=lambda item: int(item[0])):
+        print("throughput:       %8d calls/s (%s threads)" % (rate, threads))
+    for spin, latency in sorted(results['sqlite_latency_us'].items(), key=lambda item: float(item[0])):
+        print("sqlite query:     %8.2f us/call (spin=%ss, %d CPUs)" % (latency, spin, results['cpus']))
+
+
+def main(argv):
+    calls = int(argv[1]) if len(argv) > 1 else 20000
+    report(run(calls))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Raphaël Barrois
+# This software is distributed under the two-clause BSD license.
+
+"""A worker process, joining the test transaction through a shareddb socket.
+
+Usage: python -m tests.remote_worker <socket path>
+"""
+
+import json
+import sys
+
+from django.conf import settings
+
+
+def main(socket_path):
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'shareddb.backends.remote',
+                'INNER_ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+                'SHAREDDB_SOCKET': socket_path,
+            },
+        },
+        INSTALLED_APPS=['tests.testapp'],
+    )
+
+    from django.db import connection, transaction
+    from tests.testapp import models
+
+    report = {'seen': list(models.Something.objects.order_by('pk').values_list('data', flat=True))}
+    models.Something.objects.create(data='child')
+
+    try:
+        with transaction.atomic():
+            models.Something.objects.create(data='rollback')
+            raise ValueError()
+    except ValueError:
+        pass
+
+    with transaction.atomic():
+        models.Something.objects.create(data='atomic')
+
+    connection.close()
+    sys.stdout.write(json.dumps(report))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -2,13 +2,707 @@
 # Copyright (c) 2014 Raphaël Barrois
 # This software is distributed under the two-clause BSD license.
 
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
 
 import requests
 
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, connections, transaction
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import six
+
+from shareddb import remote
 from shareddb import testcase
+from shareddb import threlegate
+from shareddb.backends.shareddb import base
+from shareddb.backends.shareddb import creation
 
 from .testapp import models
 
+try:
+    from shareddb import pytest_plugin
+except ImportError:  # pytest isn't installed
+    pytest_plugin = None
+
+
+class FakeCursor(object):
+    """A DB-API cursor lookalike, recording the threads it runs on."""
+    arraysize = 1
+    description = (('x', None, None, None, None, None, None),)
+    rowcount = -1
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.calls = []
+        self.threads = set()
+
+    def _record(self, name):
+        self.calls.append(name)
+        self.threads.add(threading.current_thread().ident)
+
+    def execute(self, sql, params=None):
+        self._record('execute')
+        self.pending = list(self.rows)
+
+    def fetchmany(self, size):
+        self._record('fetchmany')
+        rows, self.pending = self.pending[:size], self.pending[size:]
+        return rows
+
+    def fetchall(self):
+        self._record('fetchall')
+        rows, self.pending = self.pending, []
+        return rows
+
+    def close(self):
+        self._record('close')
+
+
+class TupleCursor(FakeCursor):
+    """Returns rows in tuples, like MySQLdb."""
+
+    def fetchmany(self, size):
+        return tuple(super(TupleCursor, self).fetchmany(size))
+
+
+class DelegatingCursorTests(unittest.TestCase):
+    def setUp(self):
+        self.delegate = threlegate.DelegateQueue(name='test-cursor')
+        self.delegate.start()
+        self.inner = FakeCursor((i,) for i in range(25))
+        self.cursor = base.DelegatingCursor(self.inner, self.delegate, fetch_size=10)
+
+    def tearDown(self):
+        self.delegate.stop()
+
+    def test_runs_on_delegate(self):
+        self.cursor.execute("SELECT 1")
+        self.cursor.fetchall()
+        self.cursor.close()
+        self.assertEqual(['execute', 'fetchmany', 'fetchall', 'close'], self.inner.calls)
+        self.assertEqual(set([self.delegate.inner_thread.ident]), self.inner.threads)
+
+    def test_single_hop_read(self):
+        delegate = threlegate.DelegateQueue(name='test-cursor-stats', stats=True)
+        delegate.start()
+        self.addCleanup(delegate.stop)
+        cursor = base.DelegatingCursor(FakeCursor([(1,)]), delegate, fetch_size=10)
+        cursor.execute("SELECT 1")
+        self.assertEqual((1,), cursor.fetchone())
+        self.assertIsNone(cursor.fetchone())
+        self.assertEqual(1, delegate.stats.tasks)
+
+    def test_fetchone_prefetches(self):
+        self.cursor.execute("SELECT 1")
+        rows = list(self.cursor)
+        self.assertEqual([(i,) for i in range(25)], rows)
+        self.assertEqual(['execute'] + ['fetchmany'] * 3, self.inner.calls)
+
+    def test_mixed_fetches(self):
+        self.cursor.execute("SELECT 1")
+        self.assertEqual((0,), self.cursor.fetchone())
+        self.assertEqual([(1,), (2,)], self.cursor.fetchmany(2))
+        self.assertEqual([(i,) for i in range(3, 25)], self.cursor.fetchall())
+        self.assertIsNone(self.cursor.fetchone())
+        self.assertEqual([], self.cursor.fetchmany(5))
+
+    def test_cached_rows_type(self):
+        inner = TupleCursor((i,) for i in range(3))
+        cache = base.QueryCache(2)
+        for _i in range(2):
+            cursor = base.DelegatingCursor(inner, self.delegate, fetch_size=10, cache=cache)
+            cursor.execute("SELECT 1")
+            self.assertEqual(((0,), (1,), (2,)), cursor.fetchmany(5))
+            self.assertEqual((), cursor.fetchmany(5))
+        self.assertEqual(1, cache.hits)
+
+    def test_locking_reads_not_cached(self):
+        inner = TupleCursor((i,) for i in range(3))
+        cache = base.QueryCache(2)
+        cursor = base.DelegatingCursor(inner, self.delegate, fetch_size=10, cache=cache)
+        for sql in ["SELECT 1 FOR SHARE", "SELECT 1 FOR SHARE", "SELECT 1 INTO t", "SELECT 1 INTO t"]:
+            cursor.execute(sql)
+        self.assertEqual(['execute'] * 4, inner.calls)
+        self.assertEqual(0, len(cache))
+
+    def test_listeners(self):
+        queries = []
+        cursor = base.DelegatingCursor(self.inner, self.delegate, fetch_size=10, listeners=[queries.append])
+        cursor.execute("SELECT %s", [1])
+        list(cursor)
+        self.assertEqual(1, len(queries))
+        self.assertEqual("SELECT %s", queries[0]['sql'])
+        self.assertEqual([1], queries[0]['params'])
+        self.assertEqual(threading.current_thread(), queries[0]['thread'])
+        self.assertEqual(25, queries[0]['fetched'])
+
+    def test_execute_resets_buffer(self):
+        self.cursor.execute("SELECT 1")
+        self.cursor.fetchone()
+        self.cursor.execute("SELECT 1")
+        self.assertEqual((0,), self.cursor.fetchone())
+
+
+class LockModeTests(unittest.TestCase):
+    alias = 'shareddb-lock-test'
+
+    def setUp(self):
+        self.settings_dict = dict(connections.databases['default'],
+            NAME=':memory:',
+            SHAREDDB_MODE='lock',
+        )
+
+    def tearDown(self):
+        base.DELEGATES.pop(self.alias, None)
+
+    def test_invalid_mode(self):
+        self.settings_dict['SHAREDDB_MODE'] = 'fork'
+        self.assertRaises(ImproperlyConfigured, base.make_wrapper, self.settings_dict, self.alias)
+
+    def test_scheduling_requires_thread_mode(self):
+        self.settings_dict['SHAREDDB_SCHEDULING'] = 'priority'
+        self.assertRaises(ImproperlyConfigured, base.make_wrapper, self.settings_dict, self.alias)
+
+    def test_runs_on_caller_thread(self):
+        wrapper = base.make_wrapper(self.settings_dict, self.alias)
+        self.assertIsInstance(base.DELEGATES[self.alias], threlegate.DelegateLock)
+        wrapper.cursor().execute("CREATE TABLE t (x INTEGER)")
+
+        threads = []
+
+        def insert():
+            wrapper.cursor().execute("INSERT INTO t VALUES (%s)", [threading.current_thread().ident])
+            threads.append(wrapper.delegate.execute(threading.current_thread))
+
+        thread = threading.Thread(target=insert)
+        thread.start()
+        thread.join()
+
+        self.assertEqual([thread], threads)
+        cursor = wrapper.cursor()
+        cursor.execute("SELECT x FROM t")
+        self.assertEqual([(thread.ident,)], cursor.fetchall())
+        wrapper.close()
+
+
+class SchedulingSettingsTests(unittest.TestCase):
+    alias = 'shareddb-scheduling-test'
+
+    def tearDown(self):
+        delegate = base.DELEGATES.pop(self.alias, None)
+        if delegate is not None:
+            delegate.stop()
+
+    def test_invalid(self):
+        settings_dict = dict(connections.databases['default'], SHAREDDB_SCHEDULING='lifo')
+        self.assertRaises(ImproperlyConfigured, base.make_delegate, settings_dict, self.alias)
+
+    def test_round_robin(self):
+        settings_dict = dict(connections.databases['default'], SHAREDDB_SCHEDULING='round-robin')
+        delegate = base.make_delegate(settings_dict, self.alias)
+        self.assertIsInstance(delegate.inner_queue, threlegate.RoundRobinQueue)
+
+    def test_coalesce_requires_fifo(self):
+        settings_dict = dict(connections.databases['default'],
+            SHAREDDB_SCHEDULING='priority', SHAREDDB_COALESCE=True)
+        self.assertRaises(ImproperlyConfigured, base.make_delegate, settings_dict, self.alias)
+
+
+class LazyDelegateTests(unittest.TestCase):
+    alias = 'shareddb-lazy-test'
+
+    def setUp(self):
+        self.settings_dict = dict(connections.databases['default'], NAME=':memory:')
+        self.delegates = dict(base.DELEGATES)
+        self.wrappers = dict(base.SHARED_WRAPPERS)
+
+    def tearDown(self):
+        base.DELEGATES.clear()
+        base.DELEGATES.update(self.delegates)
+        base.SHARED_WRAPPERS.clear()
+        base.SHARED_WRAPPERS.update(self.wrappers)
+
+    def test_lazy_start(self):
+        wrapper = base.make_wrapper(self.settings_dict, self.alias)
+        self.assertFalse(wrapper.delegate.running)
+        wrapper.close()
+        self.assertFalse(wrapper.delegate.running)
+
+        wrapper.cursor().execute("SELECT 1")
+        self.assertTrue(wrapper.delegate.running)
+        wrapper.close()
+        wrapper.delegate.stop()
+
+    def test_shutdown_delegates(self):
+        base.DELEGATES.clear()
+        base.SHARED_WRAPPERS.clear()
+        wrapper = base.SHARED_WRAPPERS[self.alias] = base.make_wrapper(self.settings_dict, self.alias)
+        wrapper.cursor().execute("SELECT 1")
+
+        base.shutdown_delegates()
+        self.assertFalse(wrapper.delegate.running)
+        self.assertTrue(wrapper.delegate.started)
+
+        # Revived on demand
+        wrapper.cursor().execute("SELECT 1")
+        self.assertTrue(wrapper.delegate.running)
+        base.shutdown_delegates()
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "Requires os.fork().")
+class ForkTests(unittest.TestCase):
+    def run_in_child(self, check):
+        """Run check() in a forked child, returning whether it returned True."""
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                ok = check()
+            finally:
+                os._exit(0 if ok else 1)
+        _pid, status = os.waitpid(pid, 0)
+        return status == 0
+
+    def test_reset_after_fork(self):
+        parent = connections['default']
+        parent.delegate.execute(len, '')
+
+        def check():
+            base.reset_after_fork({'default': {'NAME': 'clone'}})
+            wrapper = connections['default']
+            return (
+                wrapper is not parent
+                and not parent.delegate.started
+                and wrapper.settings_dict['NAME'] == 'clone'
+                and wrapper.delegate.execute(len, 'abc') == 3
+            )
+
+        self.assertTrue(self.run_in_child(check))
+        # The parent is untouched
+        self.assertIs(parent, connections['default'])
+        self.assertEqual(3, parent.delegate.execute(len, 'abc'))
+
+
+class PipelineTests(unittest.TestCase):
+    alias = 'shareddb-pipeline-test'
+
+    def setUp(self):
+        settings_dict = dict(connections.databases['default'],
+            NAME=':memory:',
+            SHAREDDB_PIPELINE=True,
+        )
+        self.wrapper = base.make_wrapper(settings_dict, self.alias)
+        self.wrapper.cursor().execute("CREATE TABLE t (x INTEGER)")
+        # Available to transaction.atomic(), from this thread.
+        setattr(connections._connections, self.alias, self.wrapper)
+
+        self.queries = []
+        self.wrapper.query_listeners.append(self.queries.append)
+        self.deferred = []
+        execute_nowait = self.wrapper.delegate.execute_nowait
+
+        def record_nowait(function, *args):
+            self.deferred.append(function.__name__)
+            execute_nowait(function, *args)
+        self.wrapper.delegate.execute_nowait = record_nowait
+
+    def tearDown(self):
+        delattr(connections._connections, self.alias)
+        self.wrapper.close()
+        base.DELEGATES.pop(self.alias).stop()
+
+    def test_savepoint_commit(self):
+        with transaction.atomic(using=self.alias):
+            with transaction.atomic(using=self.alias):
+                self.wrapper.cursor().execute("INSERT INTO t VALUES (1)")
+            self.assertEqual(['savepoint_commit'], self.deferred)
+            # Run in order with later calls.
+            self.wrapper.cursor().execute("INSERT INTO t VALUES (2)")
+
+        statements = [query['sql'].split()[0] for query in self.queries]
+        self.assertEqual(['BEGIN', 'SAVEPOINT', 'INSERT', 'RELEASE', 'INSERT'], statements)
+        cursor = self.wrapper.cursor()
+        cursor.execute("SELECT x FROM t")
+        self.assertEqual([(1,), (2,)], cursor.fetchall())
+
+    def test_savepoint_commit_error(self):
+        with transaction.atomic(using=self.alias):
+            cursor = self.wrapper.cursor()
+            cursor.execute("INSERT INTO t VALUES (1)")
+            # Fails on the delegate...
+            self.wrapper.savepoint_commit('missing')
+            self.assertEqual(['savepoint_commit'], self.deferred)
+            # ... and is reported by the next call, which is skipped.
+            self.assertRaises(DatabaseError, cursor.execute, "INSERT INTO t VALUES (2)")
+            cursor.execute("SELECT x FROM t")
+            self.assertEqual([(1,)], cursor.fetchall())
+
+    def test_disabled(self):
+        wrapper = base.make_wrapper(dict(connections.databases['default'], NAME=':memory:'), 'shareddb-nopipeline-test')
+        self.assertFalse(wrapper.pipeline)
+        wrapper.close()
+        base.DELEGATES.pop('shareddb-nopipeline-test').stop()
+
+
+class QueryCacheTests(unittest.TestCase):
+    alias = 'shareddb-cache-test'
+
+    def setUp(self):
+        settings_dict = dict(connections.databases['default'],
+            NAME=':memory:',
+            SHAREDDB_QUERY_CACHE=2,
+        )
+        self.wrapper = base.make_wrapper(settings_dict, self.alias)
+        self.cache = self.wrapper.query_cache
+        self.queries = []
+        self.wrapper.query_listeners.append(self.queries.append)
+        cursor = self.wrapper.cursor()
+        cursor.execute("CREATE TABLE t (x INTEGER)")
+        cursor.execute("INSERT INTO t VALUES (1)")
+
+    def tearDown(self):
+        self.wrapper.close()
+        base.DELEGATES.pop(self.alias).stop()
+
+    def select(self, sql="SELECT x FROM t", params=None):
+        cursor = self.wrapper.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def cached(self):
+        return [query['cached'] for query in self.queries if query['sql'].startswith('SELECT')]
+
+    def test_hit(self):
+        self.assertEqual([(1,)], self.select())
+        cursor = self.wrapper.cursor()
+        cursor.execute("SELECT x FROM t")
+        self.assertEqual([(1,)], cursor.fetchall())
+        self.assertEqual('x', cursor.description[0][0])
+        self.assertEqual([False, True], self.cached())
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_params(self):
+        self.assertEqual([(1,)], self.select("SELECT x FROM t WHERE x = %s", [1]))
+        self.assertEqual([], self.select("SELECT x FROM t WHERE x = %s", [2]))
+        self.assertEqual([(1,)], self.select("SELECT x FROM t WHERE x = %s", (1,)))
+        self.assertEqual([False, False, True], self.cached())
+
+    def test_invalidated_by_write(self):
+        self.select()
+        self.wrapper.cursor().execute("INSERT INTO t VALUES (2)")
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual([(1,), (2,)], self.select())
+        self.assertEqual([False, False], self.cached())
+
+    def test_invalidated_by_savepoint_rollback(self):
+        self.wrapper.set_autocommit(False)
+        # SQLite only uses savepoints within atomic blocks.
+        self.wrapper.in_atomic_block = True
+        sid = self.wrapper.savepoint()
+        self.select()
+        self.wrapper.savepoint_rollback(sid)
+        self.wrapper.in_atomic_block = False
+        self.assertEqual(0, len(self.cache))
+
+    def test_invalidated_by_rollback(self):
+        self.wrapper.set_autocommit(False)
+        self.select()
+        self.wrapper.rollback()
+        self.assertEqual(0, len(self.cache))
+
+    def test_lru(self):
+        self.select("SELECT x FROM t WHERE x = 1")
+        self.select("SELECT x FROM t WHERE x = 2")
+        self.select("SELECT x FROM t WHERE x = 1")
+        self.select("SELECT x FROM t WHERE x = 3")
+        self.assertEqual(2, len(self.cache))
+        self.select("SELECT x FROM t WHERE x = 1")
+        self.select("SELECT x FROM t WHERE x = 2")
+        self.assertEqual([False, False, True, False, True, False], self.cached())
+
+    def test_large_results_not_cached(self):
+        self.wrapper.cursor().executemany("INSERT INTO t VALUES (%s)",
+            [(i,) for i in range(self.cache.max_rows)])
+        self.assertEqual(self.cache.max_rows + 1, len(self.select()))
+        self.assertEqual(0, len(self.cache))
+
+    def test_uncached(self):
+        self.wrapper.uncached = ('/* uncached */',)
+        self.select("SELECT x FROM t /* uncached */")
+        self.select("SELECT x FROM t /* uncached */")
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual([False, False], self.cached())
+
+    def test_deferred_error(self):
+        self.select()
+        cursor = self.wrapper.cursor()
+        self.wrapper.delegate.execute_nowait(lambda: 1 / 0)
+        # Not served from the cache: the error is reported first.
+        self.assertRaises(ZeroDivisionError, cursor.execute, "SELECT x FROM t")
+        cursor.execute("SELECT x FROM t")
+        self.assertEqual([(1,)], cursor.fetchall())
+        # Failed statements are reported, too.
+        self.assertEqual([False, False, True], self.cached())
+
+    def test_disabled(self):
+        self.assertIsNone(connections['default'].query_cache)
+
+
+class CoalesceTests(unittest.TestCase):
+    alias = 'shareddb-coalesce-test'
+
+    def setUp(self):
+        settings_dict = dict(connections.databases['default'],
+            NAME=':memory:',
+            SHAREDDB_COALESCE=True,
+        )
+        self.wrapper = base.make_wrapper(settings_dict, self.alias)
+        self.queries = []
+        self.wrapper.query_listeners.append(self.queries.append)
+        cursor = self.wrapper.cursor()
+        cursor.execute("CREATE TABLE t (x INTEGER)")
+        cursor.execute("INSERT INTO t VALUES (1)")
+
+    def tearDown(self):
+        self.wrapper.close()
+        base.DELEGATES.pop(self.alias).stop()
+
+    def test_read(self):
+        cursor = self.wrapper.cursor()
+        cursor.execute("SELECT x FROM t WHERE x = %s", [1])
+        self.assertEqual('x', cursor.description[0][0])
+        self.assertEqual([(1,)], cursor.fetchall())
+        self.assertFalse(self.queries[-1]['coalesced'])
+
+    def test_large_result(self):
+        self.wrapper.cursor().executemany("INSERT INTO t VALUES (%s)",
+            [(i,) for i in range(self.wrapper.fetch_size + 10)])
+        cursor = self.wrapper.cursor()
+        cursor.execute("SELECT x FROM t")
+        self.assertEqual(self.wrapper.fetch_size + 11, len(cursor.fetchall()))
+
+    def test_concurrent(self):
+        event = threading.Event()
+        cursors = [self.wrapper.cursor() for _i in range(3)]
+        results = []
+
+        def read(cursor):
+            cursor.execute("SELECT x FROM t")
+            results.append(cursor.fetchall())
+
+        self.wrapper.delegate.submit(event.wait, 10)
+        threads = [threading.Thread(target=read, args=(cursor,)) for cursor in cursors]
+        for thread in threads:
+            thread.start()
+        for _i in range(500):
+            flight = self.wrapper.delegate._flights.get(("SELECT x FROM t", None))
+            if flight is not None and len(flight.waiters) == 2:
+                break
+            time.sleep(0.01)
+        event.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([[(1,)]] * 3, results)
+        reads = [query for query in self.queries if query['sql'] == "SELECT x FROM t"]
+        self.assertEqual([False, True, True], sorted(query['coalesced'] for query in reads))
+
+    def test_disabled(self):
+        self.assertFalse(connections['default'].coalesce)
+
+
+class TestTemplateTests(unittest.TestCase):
+    alias = 'shareddb-template-test'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.test_name = os.path.join(self.tmpdir, 'test.sqlite3')
+        connections.databases[self.alias] = dict(connections.databases['default'],
+            NAME=os.path.join(self.tmpdir, 'main.sqlite3'),
+            TEST_NAME=self.test_name,
+            SHAREDDB_TEST_TEMPLATE=True,
+        )
+        self.wrapper = connections[self.alias]
+
+    def tearDown(self):
+        self.wrapper.close()
+        base.DELEGATES.pop(self.alias).stop()
+        del base.SHARED_WRAPPERS[self.alias]
+        delattr(connections._connections, self.alias)
+        del connections.databases[self.alias]
+        shutil.rmtree(self.tmpdir)
+
+    def create_test_db(self):
+        stdout, sys.stdout = sys.stdout, six.StringIO()
+        try:
+            self.wrapper.creation.create_test_db(verbosity=1, autoclobber=True)
+        finally:
+            stdout, sys.stdout = sys.stdout, stdout
+        return stdout.getvalue()
+
+    def templates(self):
+        return [name for name in os.listdir(self.tmpdir) if name.endswith('.template')]
+
+    def test_fingerprint(self):
+        fingerprint = creation.schema_fingerprint(self.wrapper)
+        self.assertEqual(fingerprint, creation.schema_fingerprint(self.wrapper))
+        self.assertEqual(fingerprint, creation.schema_fingerprint(connections['default']))
+
+    def test_reuse(self):
+        self.assertIn("Creating test database", self.create_test_db())
+        self.assertEqual(1, len(self.templates()))
+        models.Something.objects.using(self.alias).create(data='ex1')
+
+        self.assertIn("Cloning test database", self.create_test_db())
+        self.assertEqual(self.test_name, self.wrapper.settings_dict['NAME'])
+        # Back to the template's content
+        self.assertEqual(0, models.Something.objects.using(self.alias).count())
+
+    def test_stale_templates(self):
+        stale = self.test_name + '.0123456789abcdef.template'
+        open(stale, 'w').close()
+        self.assertIn("Creating test database", self.create_test_db())
+        self.assertEqual(1, len(self.templates()))
+        self.assertFalse(os.path.exists(stale))
+
+    def test_memory(self):
+        self.assertIsNone(creation.get_template_store(self.wrapper, ':memory:'))
+
+
+class FakePytestConfig(object):
+    def getoption(self, name):
+        return name == 'shareddb'
+
+    def getini(self, name):
+        return False
+
+
+@unittest.skipIf(pytest_plugin is None, "Requires pytest.")
+class PytestPluginTests(unittest.TestCase):
+    def test_configure(self):
+        databases = {
+            'default': dict(connections['default'].settings_dict),
+            'plain': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+        }
+        default = dict(databases['default'])
+        with override_settings(DATABASES=databases):
+            pytest_plugin.pytest_configure(FakePytestConfig())
+        # Already wrapped: unchanged.
+        self.assertEqual(default, databases['default'])
+        self.assertEqual('shareddb.backends.shareddb', databases['plain']['ENGINE'])
+        self.assertEqual('django.db.backends.sqlite3', databases['plain']['INNER_ENGINE'])
+
+
+class RunPerDatabaseTest(TestCase):
+    def test_runs_on_delegate(self):
+        threads = []
+        testcase.run_per_database(['default', 'default'], lambda db_name: threads.append(
+            (db_name, threading.current_thread())))
+        delegate_thread = connections['default'].delegate.inner_thread
+        self.assertEqual([('default', delegate_thread)] * 2, threads)
+
+
+class MirrorTest(TestCase):
+    def test_shared_wrapper(self):
+        replica = connections['replica']
+        self.assertIs(connections['default'], replica.primary)
+        self.assertIs(connections['default'].delegate, replica.delegate)
+        self.assertNotIn('replica', base.DELEGATES)
+        # Still seen as a mirror.
+        self.assertEqual('replica', replica.alias)
+        self.assertEqual('default', replica.settings_dict['TEST_MIRROR'])
+
+    def test_shared_transaction_state(self):
+        depth = len(connections['default'].savepoint_ids)
+        with transaction.atomic(using='replica'):
+            self.assertEqual(depth + 1, len(connections['default'].savepoint_ids))
+
+    def test_sees_test_transaction(self):
+        models.Something.objects.create(data='ex1')
+        self.assertEqual(['ex1'], [s.data for s in models.Something.objects.using('replica')])
+
+    def test_get_mirror(self):
+        self.assertEqual('default', base.get_mirror(connections.databases['replica']))
+        self.assertEqual('default', base.get_mirror({'TEST': {'MIRROR': 'default'}}))
+        self.assertIsNone(base.get_mirror(connections.databases['default']))
+
+
+class MirrorFixturesTest(TestCase):
+    multi_db = True
+    # Without primary keys: loading them twice would duplicate them.
+    fixtures = ['nopk']
+
+    def test_loaded_once(self):
+        self.assertEqual(['fx'], [s.data for s in models.Something.objects.all()])
+
+
+class MirrorFixturesLiveServerTest(testcase.LiveServerTestCase):
+    multi_db = True
+    fixtures = ['nopk']
+
+    def test_loaded_once(self):
+        self.assertEqual(['fx'], [s.data for s in models.Something.objects.all()])
+
+
+class LazySavepointTest(TestCase):
+    def savepoint_queries(self, queries):
+        return [query['sql'] for query in queries if 'SAVEPOINT' in query['sql']]
+
+    def test_is_read(self):
+        self.assertTrue(base.is_read(' select 1'))
+        self.assertFalse(base.is_read('SELECT * FROM t FOR UPDATE'))
+        self.assertFalse(base.is_read('SELECT * FROM t FOR SHARE'))
+        self.assertFalse(base.is_read('SELECT * FROM t for no key update nowait'))
+        self.assertFalse(base.is_read('SELECT * FROM t FOR KEY SHARE'))
+        self.assertFalse(base.is_read('SELECT * FROM t LOCK IN SHARE MODE'))
+        self.assertFalse(base.is_read('SELECT * INTO t2 FROM t'))
+        self.assertTrue(base.is_read('SELECT for_update, intonation FROM t'))
+        self.assertFalse(base.is_read('INSERT INTO t VALUES (1)'))
+        self.assertFalse(base.is_read(''))
+
+    def test_read_only(self):
+        with testcase.QueryCapture() as queries:
+            with transaction.atomic():
+                models.Something.objects.count()
+        self.assertEqual(1, len(queries))
+        self.assertEqual([], self.savepoint_queries(queries))
+        self.assertEqual([], connections['default'].pending_savepoints)
+
+    def test_write_rollback(self):
+        models.Something.objects.create(data='kept')
+        with testcase.QueryCapture() as queries:
+            try:
+                with transaction.atomic():
+                    with transaction.atomic():
+                        models.Something.objects.count()
+                    models.Something.objects.create(data='dropped')
+                    raise ValueError()
+            except ValueError:
+                pass
+        self.assertEqual(2, len(self.savepoint_queries(queries)))
+        self.assertEqual(['kept'], [s.data for s in models.Something.objects.all()])
+
+    def test_nested_write(self):
+        with transaction.atomic():
+            models.Something.objects.create(data='outer')
+            try:
+                with transaction.atomic():
+                    models.Something.objects.create(data='inner')
+                    raise ValueError()
+            except ValueError:
+                pass
+        self.assertEqual(['outer'], [s.data for s in models.Something.objects.all()])
+
+
 class BaseTest(testcase.LiveServerTestCase):
     def test_simple_db_access(self):
         self.assertEqual(0, models.Something.objects.count())
@@ -38,3 +732,203 @@ class BaseTest(testcase.LiveServerTestCase):
 
         data = response.json()
         self.assertEqual([{'pk': s.pk, 'data': 'ex1'}], data)
+
+    def test_atomic_read_no_savepoint(self):
+        with testcase.QueryCapture(exclude_thread=threading.current_thread()) as queries:
+            response = requests.get(self.live_server_url + '/atomic-read/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, len(queries), queries.describe())
+
+    def test_read_many(self):
+        models.Something.objects.bulk_create(
+            models.Something(data='d%d' % i) for i in range(1200))
+        response = requests.get(self.live_server_url + '/read/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1200, len(response.json()))
+
+    def test_query_capture(self):
+        models.Something.objects.create(data='ex1')
+        models.Something.objects.create(data='ex2')
+        with testcase.QueryCapture() as queries:
+            models.Something.objects.count()
+            response = requests.get(self.live_server_url + '/read/')
+        self.assertEqual(200, response.status_code)
+
+        self.assertEqual(2, len(queries))
+        self.assertEqual(threading.current_thread(), queries[0]['thread'])
+        self.assertEqual(self.server_thread, queries[1]['thread'])
+        self.assertIn('SELECT', queries[1]['sql'])
+        self.assertEqual(2, queries[1]['fetched'])
+        self.assertGreaterEqual(queries[1]['duration'], 0)
+
+    def test_assert_server_queries(self):
+        with self.assertNumServerQueries(1):
+            models.Something.objects.count()
+            requests.get(self.live_server_url + '/read/')
+        self.assertMaxServerQueries(2, requests.get, self.live_server_url + '/read/')
+        with self.assertRaises(AssertionError):
+            with self.assertMaxServerQueries(0):
+                requests.get(self.live_server_url + '/read/')
+
+    def test_assert_server_queries_atomic(self):
+        # Savepoints are run by the delegate, on behalf of the test thread.
+        with self.assertNumServerQueries(0):
+            with transaction.atomic():
+                models.Something.objects.create(data='at1')
+
+    def test_stats(self):
+        stats = base.DELEGATES['default'].stats
+        before = stats.tasks
+        response = requests.get(self.live_server_url + '/read/')
+        self.assertEqual(200, response.status_code)
+        self.assertGreater(stats.tasks, before)
+        self.assertIn(self.server_thread.name, stats.threads)
+
+    def test_stats_report(self):
+        class FakeDelegate(object):
+            def __init__(self):
+                self.stats = threlegate.DelegateStats()
+
+        requests.get(self.live_server_url + '/read/')
+        # A transient alias, and a configured one without any task.
+        base.DELEGATES['__transient__'] = FakeDelegate()
+        base.DELEGATES['__transient__'].stats.record('test', 0.0, 0.0, 1)
+        idle = base.DELEGATES.setdefault('replica', FakeDelegate())
+        try:
+            report = testcase.stats_report()
+        finally:
+            del base.DELEGATES['__transient__']
+            if idle.__class__ is FakeDelegate:
+                del base.DELEGATES['replica']
+
+        self.assertIn("shareddb stats for 'default':", report)
+        self.assertFalse(any('__transient__' in line for line in report))
+        self.assertNotIn("shareddb stats for 'replica':", report)
+
+
+class SharedServerTest(testcase.LiveServerTestCase):
+    shared_live_server = True
+
+    def test_shared_thread(self):
+        self.assertIs(testcase.SHARED_SERVER_THREAD, self.server_thread)
+
+    def test_read_exists(self):
+        s = models.Something.objects.create(data='ex1')
+        response = requests.get(self.live_server_url + '/read/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'pk': s.pk, 'data': 'ex1'}], response.json())
+
+
+class OtherSharedServerTest(testcase.LiveServerTestCase):
+    shared_live_server = True
+
+    def test_shared_thread(self):
+        self.assertIs(testcase.SHARED_SERVER_THREAD, self.server_thread)
+        self.assertTrue(self.server_thread.is_alive())
+
+    def test_isolation(self):
+        # Rows created by other test classes were rolled back.
+        response = requests.get(self.live_server_url + '/read/')
+        self.assertEqual(b'[]', response.content)
+
+
+class PooledServerTest(testcase.LiveServerTestCase):
+    live_server_threads = 4
+
+    def test_pool(self):
+        self.assertIsInstance(self.server_thread.httpd, testcase.PooledWSGIServer)
+        self.assertEqual(4, len(self.server_thread.httpd.workers))
+
+    def test_read_exists(self):
+        s = models.Something.objects.create(data='ex1')
+        response = requests.get(self.live_server_url + '/read/')
+        self.assertEqual([{'pk': s.pk, 'data': 'ex1'}], response.json())
+
+    def test_run_load(self):
+        models.Something.objects.create(data='ex1')
+        with testcase.QueryCapture(exclude_thread=threading.current_thread()) as queries:
+            result = self.run_load('/read/', clients=4, requests=20)
+        self.assertEqual(20, result.requests)
+        self.assertEqual(0, result.errors)
+        self.assertLessEqual(result.p50, result.p99)
+        self.assertGreater(result.throughput, 0)
+        # default collects stats
+        self.assertGreaterEqual(result.delegate_tasks, 20)
+        self.assertEqual(20, len(queries))
+        self.assertTrue(all(query['thread'].name.startswith('live-server-') for query in queries))
+        self.assertEqual(3, len(result.summary()))
+
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(50.0, testcase.percentile(values, 50))
+        self.assertEqual(99.0, testcase.percentile(values, 99))
+        self.assertEqual(1.0, testcase.percentile([1.0], 99))
+        self.assertEqual(0.0, testcase.percentile([], 50))
+
+
+class TestDataTest(testcase.LiveServerTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.first = models.Something.objects.create(data='first')
+        cls.second = models.Something.objects.create(data='second')
+
+    def check_and_alter(self):
+        response = requests.get(self.live_server_url + '/read/')
+        self.assertEqual([
+            {'pk': self.first.pk, 'data': 'first'},
+            {'pk': self.second.pk, 'data': 'second'},
+        ], response.json())
+        models.Something.objects.filter(pk=self.first.pk).delete()
+        models.Something.objects.create(data='third')
+
+    def test_alter_once(self):
+        self.check_and_alter()
+
+    def test_alter_twice(self):
+        self.check_and_alter()
+
+    def test_in_savepoint(self):
+        connection = connections['default']
+        self.assertTrue(connection.in_atomic_block)
+        # One savepoint for this test, within the class-wide transaction
+        self.assertEqual(1, len(connection.savepoint_ids))
+
+
+class RemoteSessionTests(unittest.TestCase):
+    def test_requires_transaction(self):
+        # Outside of a test case, the shared connection is in autocommit mode.
+        server = remote.DelegateServer('default', 'unused.sock')
+        session = remote.RemoteSession(server, sock=None)
+        session.op_set_autocommit(False)
+        self.assertRaises(transaction.TransactionManagementError, session.op_begin)
+        self.assertFalse(session.in_transaction)
+
+
+class RemoteTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = remote.DelegateServer('default', os.path.join(self.tmpdir, 'default.sock'))
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_subprocess(self):
+        models.Something.objects.create(data='parent')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'tests.remote_worker', self.server.path], env=env)
+
+        self.assertEqual({'seen': ['parent']}, json.loads(output.decode('utf-8')))
+        self.assertEqual(
+            ['parent', 'child', 'atomic'],
+            list(models.Something.objects.order_by('pk').values_list('data', flat=True)),
+        )
+
+    def test_requires_shareddb(self):
+        connections.databases['other'] = dict(connections.databases['default'], ENGINE='django.db.backends.sqlite3')
+        try:
+            self.assertRaises(ImproperlyConfigured, remote.DelegateServer, 'other', self.server.path)
+        finally:
+            del connections.databases['other']
@@ -0,0 +1,663 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Raphaël Barrois
+# This software is distributed under the two-clause BSD license.
+
+
+import os
+import threading
+import time
+import unittest
+
+from shareddb import threlegate
+
+
+class DelegateQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.delegate = threlegate.DelegateQueue(name='test-delegate')
+        self.delegate.start()
+
+    def tearDown(self):
+        self.delegate.stop()
+
+    def test_execute(self):
+        self.assertEqual('/foo', self.delegate.execute(os.path.join, '/', 'foo'))
+
+    def test_runs_in_thread(self):
+        ident = self.delegate.execute(lambda: threading.current_thread().ident)
+        self.assertEqual(self.delegate.inner_thread.ident, ident)
+
+    def test_calling_thread(self):
+        current = threading.current_thread()
+        self.assertIs(current, self.delegate.calling_thread())
+        self.assertIs(current, self.delegate.execute(self.delegate.calling_thread))
+        self.assertIs(current, self.delegate.execute_batch([(self.delegate.calling_thread, (), {})])[0])
+
+    def test_exception(self):
+        self.assertRaises(ZeroDivisionError, self.delegate.execute, lambda: 1 / 0)
+        # The waiter is still usable afterwards
+        self.assertEqual(3, self.delegate.execute(max, 1, 3, 2))
+
+    def test_reentrant(self):
+        result = self.delegate.execute(self.delegate.execute, sorted, [2, 1])
+        self.assertEqual([1, 2], result)
+
+    def test_concurrent_callers(self):
+        results = {}
+
+        def call(index):
+            results[index] = [self.delegate.execute(pow, index, 2) for _i in range(100)]
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(dict((i, [i ** 2] * 100) for i in range(8)), results)
+
+    def test_execute_batch(self):
+        calls = [(len, ('abc',), {}), (os.path.join, ('/', 'foo'), {}), (int, ('10',), {'base': 2})]
+        self.assertEqual([3, '/foo', 2], self.delegate.execute_batch(calls))
+
+    def test_execute_batch_stop_on_error(self):
+        calls = []
+        batch = [(calls.append, (1,), {}), (lambda: 1 / 0, (), {}), (calls.append, (2,), {})]
+        self.assertRaises(ZeroDivisionError, self.delegate.execute_batch, batch)
+        self.assertEqual([1], calls)
+        self.assertRaises(ZeroDivisionError, self.delegate.execute_batch, batch, stop_on_error=False)
+        self.assertEqual([1, 1, 2], calls)
+
+    def test_execute_batch_runs_in_thread(self):
+        idents = self.delegate.execute_batch([(lambda: threading.current_thread().ident, (), {})] * 2)
+        self.assertEqual([self.delegate.inner_thread.ident] * 2, idents)
+
+    def test_execute_nowait(self):
+        calls = []
+        for i in range(50):
+            self.delegate.execute_nowait(calls.append, i)
+        self.assertEqual(50, self.delegate.execute(len, calls))
+        self.assertEqual(list(range(50)), calls)
+
+    def test_execute_nowait_error(self):
+        calls = []
+        self.delegate.execute_nowait(lambda: 1 / 0)
+        self.delegate.execute_nowait(calls.append, 1)
+        # Reported on the next synchronous call; neither it nor the deferred
+        # calls in between run.
+        self.assertRaises(ZeroDivisionError, self.delegate.execute, calls.append, 2)
+        self.assertEqual([], calls)
+        # Reported only once.
+        self.delegate.execute_nowait(calls.append, 3)
+        self.delegate.execute(calls.append, 4)
+        self.assertEqual([3, 4], calls)
+
+    def test_execute_nowait_other_thread(self):
+        self.delegate.execute_nowait(lambda: 1 / 0)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.delegate.execute(len, 'ab')))
+        thread.start()
+        thread.join()
+        self.assertEqual([2], results)
+        self.assertRaises(ZeroDivisionError, self.delegate.execute, len, 'ab')
+
+    def test_execute_nowait_reentrant(self):
+        self.assertRaises(ZeroDivisionError,
+            self.delegate.execute, self.delegate.execute_nowait, lambda: 1 / 0)
+
+
+@unittest.skipIf(threlegate.futures is None, "Requires the 'futures' package.")
+class DelegateQueueFuturesTests(unittest.TestCase):
+    def setUp(self):
+        self.delegate = threlegate.DelegateQueue(name='test-futures', stats=True)
+        self.delegate.start()
+
+    def tearDown(self):
+        self.delegate.shutdown()
+
+    def test_submit(self):
+        future = self.delegate.submit(os.path.join, '/', 'foo')
+        self.assertEqual('/foo', future.result())
+        self.assertEqual(1, self.delegate.stats.tasks)
+
+    def test_exception(self):
+        future = self.delegate.submit(lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, future.result)
+        self.assertIsInstance(future.exception(), ZeroDivisionError)
+
+    def test_ordering(self):
+        calls = []
+        futures = [self.delegate.submit(calls.append, i) for i in range(50)]
+        self.assertEqual(3, self.delegate.execute(len, 'abc'))
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(list(range(50)), calls)
+
+    def test_map(self):
+        self.assertEqual([0, 1, 4], list(self.delegate.map(pow, range(3), [2] * 3)))
+
+    def test_reentrant(self):
+        future = self.delegate.execute(self.delegate.submit, sorted, [2, 1])
+        self.assertTrue(future.done())
+        self.assertEqual([1, 2], future.result())
+
+    def test_cancel(self):
+        blocker = threading.Event()
+        self.delegate.submit(blocker.wait)
+        future = self.delegate.submit(len, 'abc')
+        self.assertTrue(future.cancel())
+        blocker.set()
+        self.assertEqual(1, self.delegate.execute(len, 'a'))
+        self.assertTrue(future.cancelled())
+
+    def test_lock_submit(self):
+        delegate = threlegate.DelegateLock(name='test-futures-lock')
+        delegate.start()
+        future = delegate.submit(len, 'abc')
+        delegate.stop()
+        self.assertEqual(3, future.result())
+
+
+@unittest.skipIf(threlegate.asyncio is None, "Requires asyncio.")
+class ExecuteAsyncTests(unittest.TestCase):
+    delegate_class = threlegate.DelegateQueue
+
+    def setUp(self):
+        self.delegate = self.delegate_class(name='test-async')
+        self.delegate.start()
+        self.loop = threlegate.asyncio.new_event_loop()
+        threlegate.asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        threlegate.asyncio.set_event_loop(None)
+        self.loop.close()
+        self.delegate.stop()
+
+    def run_async(self, function, *args):
+        return self.loop.run_until_complete(self.delegate.execute_async(function, *args))
+
+    def test_execute_async(self):
+        self.assertEqual('/foo', self.run_async(os.path.join, '/', 'foo'))
+
+    def test_exception(self):
+        self.assertRaises(ZeroDivisionError, self.run_async, lambda: 1 / 0)
+
+    def test_doesnt_block_loop(self):
+        # The call waits for the event loop to run a callback.
+        event = threading.Event()
+        self.loop.call_soon(event.set)
+        self.assertTrue(self.run_async(event.wait, 5))
+
+
+class DelegateLockExecuteAsyncTests(ExecuteAsyncTests):
+    delegate_class = threlegate.DelegateLock
+
+
+class LazyThreadTests(unittest.TestCase):
+    def test_lazy_start(self):
+        delegate = threlegate.DelegateQueue(name='test-lazy')
+        delegate.start()
+        self.assertFalse(delegate.running)
+        self.assertIsNone(delegate.inner_thread)
+        self.assertEqual(3, delegate.execute(len, 'abc'))
+        self.assertTrue(delegate.running)
+        delegate.stop()
+        self.assertFalse(delegate.running)
+
+    def test_stop_unused(self):
+        delegate = threlegate.DelegateQueue(name='test-lazy')
+        delegate.start()
+        delegate.stop()
+        self.assertFalse(delegate.started)
+
+    def test_idle_timeout(self):
+        delegate = threlegate.DelegateQueue(name='test-idle', idle_timeout=0.01)
+        delegate.start()
+        first = delegate.execute(threading.current_thread)
+        first.join(5)
+        self.assertFalse(first.is_alive())
+        self.assertFalse(delegate.running)
+
+        second = delegate.execute(threading.current_thread)
+        self.assertIsNot(first, second)
+        self.assertTrue(delegate.execute(delegate.in_thread))
+        self.assertFalse(delegate.in_thread())
+        delegate.stop()
+
+    def test_idle_timeout_busy(self):
+        delegate = threlegate.DelegateQueue(name='test-idle', idle_timeout=0.001)
+        delegate.start()
+        for _i in range(200):
+            delegate.execute_nowait(time.sleep, 0.0001)
+            delegate.execute(len, 'abc')
+        delegate.stop()
+
+    def test_idle_exit_race(self):
+        delegate = threlegate.DelegateQueue(name='test-idle', idle_timeout=0.01)
+        delegate.start()
+        delegate.execute(len, 'abc')
+
+        # Let a task come in right after the exiting thread looked at the queue.
+        checked = threading.Event()
+        qsize = delegate.inner_queue.qsize
+
+        def slow_qsize():
+            size = qsize()
+            if threading.current_thread() is delegate.inner_thread and not checked.is_set():
+                checked.set()
+                time.sleep(0.1)
+            return size
+        delegate.inner_queue.qsize = slow_qsize
+
+        results = []
+        checked.wait(5)
+        caller = threading.Thread(target=lambda: results.append(delegate.execute(len, 'abcd')))
+        caller.daemon = True
+        caller.start()
+        caller.join(5)
+        self.assertFalse(caller.is_alive())
+        self.assertEqual([4], results)
+        delegate.stop()
+
+
+class SchedulingTests(unittest.TestCase):
+    def run_calls(self, scheduling):
+        """Queue calls from two threads and the main thread while the delegate is busy."""
+        delegate = threlegate.DelegateQueue(name='test-%s' % scheduling, scheduling=scheduling)
+        delegate.start()
+        started, blocker = threading.Event(), threading.Event()
+        calls = []
+
+        def block():
+            started.set()
+            blocker.wait()
+
+        def queue_calls(prefix, queued):
+            delegate.execute_nowait(calls.append, prefix + '1')
+            delegate.execute_nowait(calls.append, prefix + '2')
+            queued.set()
+            # Stay alive: thread idents may be reused afterwards.
+            blocker.wait()
+
+        delegate.execute_nowait(block)
+        started.wait()
+        threads = []
+        for prefix in ('x', 'y'):
+            queued = threading.Event()
+            threads.append(threading.Thread(target=queue_calls, args=(prefix, queued)))
+            threads[-1].start()
+            queued.wait()
+        delegate.execute_nowait(calls.append, 'm1')
+        blocker.set()
+        delegate.stop()
+        for thread in threads:
+            thread.join()
+        return calls
+
+    def test_fifo(self):
+        self.assertEqual(['x1', 'x2', 'y1', 'y2', 'm1'], self.run_calls('fifo'))
+
+    def test_priority(self):
+        self.assertEqual(['m1', 'x1', 'x2', 'y1', 'y2'], self.run_calls('priority'))
+
+    def test_round_robin(self):
+        self.assertEqual(['x1', 'y1', 'm1', 'x2', 'y2'], self.run_calls('round-robin'))
+
+    def test_execute(self):
+        for scheduling in threlegate.SCHEDULERS:
+            delegate = threlegate.DelegateQueue(name='test-%s' % scheduling, scheduling=scheduling, stats=True)
+            delegate.start()
+            self.assertEqual('/foo', delegate.execute(os.path.join, '/', 'foo'))
+            self.assertEqual(3, delegate.execute(delegate.execute, len, 'abc'))
+            delegate.stop()
+            self.assertEqual(2, delegate.stats.tasks)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, threlegate.DelegateQueue, scheduling='lifo')
+
+
+class SpinTests(unittest.TestCase):
+    def setUp(self):
+        self.delegate = threlegate.DelegateQueue(name='test-delegate', spin=0.001)
+        # Also spin on single-CPU hosts.
+        self.delegate.spin = 0.001
+        self.delegate.start()
+
+    def tearDown(self):
+        self.delegate.stop()
+
+    def test_waiter_set_while_spinning(self):
+        waiter = threlegate.Waiter()
+        waiter.set()
+        waiter.wait(spin=0.001)
+        # Rearmed
+        self.assertFalse(waiter._lock.acquire(False))
+
+    def test_waiter_set_after_spinning(self):
+        waiter = threlegate.Waiter()
+        timer = threading.Timer(0.01, waiter.set)
+        timer.start()
+        waiter.wait(spin=0.0001)
+        timer.join()
+
+    def test_execute(self):
+        self.assertEqual('/foo', self.delegate.execute(os.path.join, '/', 'foo'))
+        self.assertEqual(3, self.delegate.execute(max, 1, 3, 2))
+        self.assertGreater(self.delegate.latency, 0)
+
+    def test_budget(self):
+        self.delegate.latency = 0.0001
+        self.assertEqual(0.0002, self.delegate.spin_budget())
+        self.delegate.latency = 0.0008
+        self.assertEqual(0.001, self.delegate.spin_budget())
+        # Slow calls: don't spin at all.
+        self.delegate.latency = 0.01
+        self.assertEqual(0.0, self.delegate.spin_budget())
+
+    def test_slow_call(self):
+        self.delegate.execute(time.sleep, 0.01)
+        self.assertEqual(0.0, self.delegate.spin_budget())
+
+    def test_disabled(self):
+        delegate = threlegate.DelegateQueue(name='test-delegate')
+        self.assertEqual(0.0, delegate.spin)
+        delegate.start()
+        self.assertEqual(3, delegate.execute(max, 1, 3, 2))
+        self.assertEqual(0.0, delegate.latency)
+        delegate.stop()
+
+
+class ExecuteSharedTests(unittest.TestCase):
+    def setUp(self):
+        self.delegate = threlegate.DelegateQueue(name='test-shared', stats=True)
+        self.delegate.start()
+        self.event = threading.Event()
+        self.calls = []
+
+    def tearDown(self):
+        self.event.set()
+        self.delegate.stop()
+
+    def read(self, label):
+        self.calls.append(label)
+        return label
+
+    def wait_for(self, condition):
+        for _i in range(500):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail("Timed out")
+
+    def call_shared(self, results, label):
+        thread = threading.Thread(target=lambda: results.append(
+            self.delegate.execute_shared('key', self.read, label)))
+        thread.start()
+        return thread
+
+    def test_coalesced(self):
+        self.delegate.submit(self.event.wait, 10)
+        results = []
+        threads = [self.call_shared(results, 'first')]
+        self.wait_for(lambda: 'key' in self.delegate._flights)
+        threads += [self.call_shared(results, 'other') for _i in range(2)]
+        self.wait_for(lambda: len(self.delegate._flights['key'].waiters) == 2)
+
+        self.event.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['first'], self.calls)
+        self.assertEqual(['first'] * 3, results)
+        self.assertEqual({}, self.delegate._flights)
+
+    def test_not_across_calls(self):
+        self.delegate.submit(self.event.wait, 10)
+        results = []
+        threads = [self.call_shared(results, 'first')]
+        self.wait_for(lambda: 'key' in self.delegate._flights)
+        # Another call gets queued after the first one: later ones can't join it.
+        self.delegate.execute_nowait(self.calls.append, 'write')
+        self.assertEqual({}, self.delegate._flights)
+        threads.append(self.call_shared(results, 'second'))
+        self.wait_for(lambda: 'key' in self.delegate._flights)
+
+        self.event.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['first', 'write', 'second'], self.calls)
+
+    def test_not_with_priority(self):
+        delegate = threlegate.DelegateQueue(name='test-shared-priority',
+            scheduling=threlegate.SCHEDULING_PRIORITY)
+        delegate.start()
+        self.addCleanup(delegate.stop)
+        rows = []
+        blocker = threading.Thread(target=delegate.execute, args=(self.event.wait, 10))
+        blocker.start()
+        self.wait_for(lambda: delegate.current_task is not None)
+
+        # The other thread writes, then reads; the main thread's identical
+        # read is served first, but must not share its result with it.
+        results = []
+
+        def write_then_read():
+            delegate.submit(rows.append, 'write')
+            # Once the main thread's read is queued.
+            self.wait_for(lambda: delegate.inner_queue.qsize() == 2)
+            results.append(delegate.execute_shared('key', list, rows))
+        other = threading.Thread(target=write_then_read)
+        other.start()
+        self.wait_for(lambda: delegate.inner_queue.qsize() == 1)
+
+        def release():
+            self.wait_for(lambda: delegate.inner_queue.qsize() == 3
+                or any(task.waiters for task in list(delegate._flights.values())))
+            self.event.set()
+        releaser = threading.Thread(target=release)
+        releaser.start()
+
+        self.assertEqual([], delegate.execute_shared('key', list, rows))
+        for thread in (other, releaser, blocker):
+            thread.join()
+        self.assertEqual([['write']], results)
+
+    def test_not_after_start(self):
+        self.assertEqual('first', self.delegate.execute_shared('key', self.read, 'first'))
+        self.assertEqual('second', self.delegate.execute_shared('key', self.read, 'second'))
+        self.assertEqual(2, self.delegate.stats.tasks)
+
+    def test_exception(self):
+        self.assertRaises(ZeroDivisionError, self.delegate.execute_shared, 'key', lambda: 1 / 0)
+
+    def test_reentrant(self):
+        self.assertEqual(2, self.delegate.execute(self.delegate.execute_shared, 'key', max, 1, 2))
+
+    def test_lock(self):
+        lock = threlegate.DelegateLock(name='test-lock')
+        lock.start()
+        self.assertEqual(2, lock.execute_shared('key', max, 1, 2))
+        lock.stop()
+
+
+class TimeoutTests(unittest.TestCase):
+    def setUp(self):
+        self.delegate = threlegate.DelegateQueue(name='test-timeout', timeout=0.2)
+        self.delegate.start()
+        self.event = threading.Event()
+
+    def tearDown(self):
+        self.event.set()
+        self.delegate.stop()
+
+    def blocked(self):
+        self.event.wait(10)
+
+    def test_execute(self):
+        self.assertEqual(3, self.delegate.execute(max, 1, 3, 2))
+        self.assertRaises(ZeroDivisionError, self.delegate.execute, lambda: 1 / 0)
+        self.assertIsNotNone(self.delegate.watchdog)
+
+    def test_timeout(self):
+        start = time.time()
+        with self.assertRaises(threlegate.DelegateTimeout) as context:
+            self.delegate.execute(self.blocked)
+        self.assertLess(time.time() - start, 5)
+        message = str(context.exception)
+        self.assertIn("In-flight task on test-timeout", message)
+        self.assertIn("blocked", message)
+        self.assertIn("Delegate thread test-timeout:", message)
+        self.assertIn("self.event.wait(10)", message)
+
+        # Back to normal once the blocked call returns
+        self.event.set()
+        self.assertEqual(3, self.delegate.execute(max, 1, 3, 2))
+
+    def test_queued_callers(self):
+        calls = []
+        errors = []
+
+        def caller():
+            try:
+                self.delegate.execute(calls.append, 1)
+            except threlegate.DelegateTimeout as e:
+                errors.append(e)
+
+        self.delegate.submit(self.blocked)
+        thread = threading.Thread(target=caller, name='test-caller')
+        thread.start()
+        thread.join(5)
+        self.assertEqual(1, len(errors))
+        self.assertIn("Caller thread test-caller, waiting for", str(errors[0]))
+
+        # The abandoned call doesn't run.
+        self.event.set()
+        self.delegate.execute(calls.append, 2)
+        self.assertEqual([2], calls)
+
+    def test_stop(self):
+        self.delegate.execute(max, 1, 2)
+        watchdog = self.delegate.watchdog
+        self.delegate.stop()
+        self.assertFalse(watchdog.is_alive())
+        self.assertIsNone(self.delegate.watchdog)
+        self.delegate.start()
+
+    def test_no_timeout(self):
+        delegate = threlegate.DelegateQueue(name='test-delegate')
+        delegate.start()
+        delegate.execute(max, 1, 2)
+        self.assertIsNone(delegate.watchdog)
+        delegate.stop()
+
+
+class DelegateStatsTests(unittest.TestCase):
+    def test_histogram(self):
+        histogram = threlegate.Histogram()
+        for duration in (5e-6, 5e-5, 5e-5, 2.0):
+            histogram.add(duration)
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(2.0, histogram.max)
+        self.assertEqual([1, 2, 0, 0, 0, 0, 1], histogram.counts)
+
+    def test_disabled(self):
+        delegate = threlegate.DelegateQueue(name='test-nostats')
+        self.assertIsNone(delegate.stats)
+
+    def check_stats(self, delegate):
+        delegate.start()
+        try:
+            delegate.execute(time.sleep, 0.01)
+            delegate.execute(len, 'abc')
+        finally:
+            delegate.stop()
+
+        stats = delegate.stats.as_dict()
+        self.assertEqual(2, stats['tasks'])
+        self.assertEqual(2, stats['run']['count'])
+        self.assertGreaterEqual(stats['run']['max'], 0.01)
+        self.assertEqual(1, stats['max_depth'])
+        self.assertEqual({threading.current_thread().name: 2}, stats['threads'])
+        self.assertIn("tasks: 2, max depth: 1", delegate.stats.summary())
+
+        delegate.stats.reset()
+        self.assertEqual((0, 0.0, 0.0), delegate.stats.totals())
+
+    def test_queue(self):
+        self.check_stats(threlegate.DelegateQueue(name='test-stats', stats=True))
+
+    def test_lock(self):
+        self.check_stats(threlegate.DelegateLock(name='test-stats', stats=True))
+
+    def test_lock_reentrant(self):
+        delegate = threlegate.DelegateLock(name='test-stats', stats=True)
+        delegate.start()
+        delegate.execute(delegate.execute, len, 'abc')
+        delegate.stop()
+        self.assertEqual(1, delegate.stats.tasks)
+
+
+class TaskTests(unittest.TestCase):
+    def test_slots(self):
+        task = threlegate.Task(function=len, args=('abc',))
+        self.assertFalse(hasattr(task, '__dict__'))
+
+    def test_execute(self):
+        waiter = threlegate.Waiter()
+        task = threlegate.Task(function=len, args=('abc',), done=waiter)
+        self.assertIn('pending', repr(task))
+        task.execute()
+        waiter.wait()
+        self.assertEqual(3, task.result)
+        self.assertIn('--> 3', repr(task))
+
+
+class DelegateLockTests(unittest.TestCase):
+    def setUp(self):
+        self.delegate = threlegate.DelegateLock(name='test-lock')
+        self.delegate.start()
+
+    def tearDown(self):
+        self.delegate.stop()
+
+    def test_runs_on_caller(self):
+        ident = self.delegate.execute(lambda: threading.current_thread().ident)
+        self.assertEqual(threading.current_thread().ident, ident)
+
+    def test_calling_thread(self):
+        self.assertIs(threading.current_thread(), self.delegate.execute(self.delegate.calling_thread))
+
+    def test_owner(self):
+        self.assertIsNone(self.delegate.owner)
+        self.assertTrue(self.delegate.execute(self.delegate.is_owned))
+        self.assertTrue(self.delegate.execute(self.delegate.execute, self.delegate.is_owned))
+        self.assertIsNone(self.delegate.owner)
+        self.assertFalse(self.delegate.is_owned())
+
+    def test_exception(self):
+        self.assertRaises(ZeroDivisionError, self.delegate.execute, lambda: 1 / 0)
+        self.assertIsNone(self.delegate.owner)
+
+    def test_execute_batch(self):
+        self.assertEqual([3, True], self.delegate.execute_batch(
+            [(len, ('abc',), {}), (self.delegate.is_owned, (), {})]))
+        self.assertIsNone(self.delegate.owner)
+
+    def test_serialized(self):
+        active = []
+        overlaps = []
+
+        def work():
+            active.append(1)
+            if len(active) > 1:
+                overlaps.append(len(active))
+            active.pop()
+
+        def call():
+            for _i in range(200):
+                self.delegate.execute(work)
+
+        threads = [threading.Thread(target=call) for _i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], overlaps)